@@ -0,0 +1,56 @@
+"""ai.py - Computer opponent. Shots are chosen with a hunt/target probability
+density strategy: every placement of every ship still afloat that agrees with
+what the tracking grid shows is counted on the cells it covers, and the cell
+covered by the most placements is shot. The placements are precomputed as a
+matrix per ship size so the counting is a few vectorized numpy products."""
+
+import random
+
+import numpy
+
+from board import CELL_COUNT, PLACEMENTS, SHIP_SIZES, popcount
+
+
+def mask_to_vector(mask):
+    """Returns the mask as a float vector of CELL_COUNT 0 and 1"""
+    bits = bin(mask)[2:].zfill(CELL_COUNT)[::-1]
+    return (numpy.frombuffer(bits, dtype=numpy.uint8) == ord('1')).astype(
+        numpy.float64)
+
+# One row per placement, one column per cell
+PLACEMENT_MATRICES = dict(
+    (size, numpy.array([mask_to_vector(mask) for mask in masks]))
+    for size, masks in PLACEMENTS.iteritems())
+
+
+def choose_shot(board):
+    """Returns the cell index (row * 10 + col) to shoot on the opponent's
+    board. Only what the tracking grid shows is used: the misses, and the
+    code of the ship hit on every hit cell"""
+    misses = board.shots & ~board.hits
+    afloat = [shipcode for shipcode in board.ships
+              if not board.is_sunk(shipcode)]
+    # Target mode: only the ships already hit are counted, hunt mode
+    # otherwise
+    targets = [shipcode for shipcode in afloat
+               if board.ships[shipcode] & board.hits]
+
+    density = numpy.zeros(CELL_COUNT)
+    for shipcode in targets or afloat:
+        ship_hits = board.ships[shipcode] & board.hits
+        matrix = PLACEMENT_MATRICES[SHIP_SIZES[shipcode]]
+        # A placement may not cover a miss or a cell hit on another ship,
+        # and must cover every cell already hit on this ship
+        blocked = matrix.dot(mask_to_vector(misses | board.hits & ~ship_hits))
+        valid = blocked == 0
+        if ship_hits:
+            covered = matrix.dot(mask_to_vector(ship_hits))
+            valid &= covered == popcount(ship_hits)
+        density += valid.dot(matrix)
+
+    density[mask_to_vector(board.shots) == 1] = -1
+    best = density.max()
+    if best <= 0:
+        return random.choice([i for i in range(CELL_COUNT)
+                              if density[i] == 0])
+    return int(random.choice(numpy.flatnonzero(density == best)))
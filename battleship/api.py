@@ -6,6 +6,7 @@ primarily with communication to/from the API's users."""
 
 
 import logging
+import time
 import endpoints
 from protorpc import remote, messages
 from google.appengine.api import memcache
@@ -14,24 +15,74 @@ from google.appengine.ext import ndb
 
 from models import User, Game, Score
 from models import StringMessage, NewGameForm, GameForm, MakeMoveForm,\
-    ScoreForms, GameForms, RankForm, RankForms, GameStepForm, GameStepForms,\
-    GridForm
-from utils import get_by_urlsafe
+    ScoreForms, GameForms, RankForms, GameStepForms,\
+    GridForm, MakeMovesForm, MoveResultForm, MoveResultForms, GameUpdateForm
 from game import GameLogic
+from storage import get_repository
+from stats import instrumented, StatsMiddleware
+from utils import key_from_urlsafe, get_game_version,\
+    lock_game_version_async, cache_game_async
 from datetime import datetime
 
-import operator
-
 NEW_GAME_REQUEST = endpoints.ResourceContainer(NewGameForm)
 GET_GAME_REQUEST = endpoints.ResourceContainer(
-    urlsafe_game_key=messages.StringField(1),)
+    urlsafe_game_key=messages.StringField(1),
+    compact=messages.BooleanField(2),)
+GAME_UPDATES_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    version=messages.IntegerField(2, required=True),)
 MAKE_MOVE_REQUEST = endpoints.ResourceContainer(
     MakeMoveForm,
-    urlsafe_game_key=messages.StringField(1),)
+    urlsafe_game_key=messages.StringField(1),
+    compact=messages.BooleanField(2),)
+MAKE_MOVES_REQUEST = endpoints.ResourceContainer(
+    MakeMovesForm,
+    urlsafe_game_key=messages.StringField(1),
+    compact=messages.BooleanField(2),)
 USER_REQUEST = endpoints.ResourceContainer(user_name=messages.StringField(1),
                                            email=messages.StringField(2))
+USER_LIST_REQUEST = endpoints.ResourceContainer(
+    user_name=messages.StringField(1),
+    email=messages.StringField(2),
+    page_size=messages.IntegerField(3),
+    cursor=messages.StringField(4),)
 GET_HIGHSCORE_REQUEST = endpoints.ResourceContainer(
-    number_of_results=messages.IntegerField(1),)
+    number_of_results=messages.IntegerField(1),
+    page_size=messages.IntegerField(2),
+    cursor=messages.StringField(3),)
+LIST_REQUEST = endpoints.ResourceContainer(
+    page_size=messages.IntegerField(1),
+    cursor=messages.StringField(2),)
+
+# Moves accepted by one make_moves call, enough for a whole game
+MAX_BATCH_MOVES = 200
+# Seconds during which turn notifications to a User are coalesced
+NOTIFICATION_WINDOW = 60
+DORMANT_HOURS = 12
+DORMANT_BATCH_SIZE = 100
+# All the reminder emails need to know about a dormant game
+DORMANT_GAME_PROJECTION = [Game.current_player, Game.player1, Game.player2]
+# The current player being filtered on, it cannot be projected
+USER_DORMANT_GAME_PROJECTION = [Game.player1, Game.player2]
+
+
+@ndb.tasklet
+def _notify_player_async(user_key):
+    """Enqueues the 'your turn' email to the User. The task is delayed to the
+    end of the current notification window and named after the User and the
+    window, so all the turns of a window collapse into a single email"""
+    now = int(time.time())
+    task = taskqueue.Task(
+        url='/tasks/send_notification_to_opponent',
+        params={'user_key': user_key.urlsafe()},
+        name='notify-%s-%d' % (user_key.urlsafe(),
+                               now // NOTIFICATION_WINDOW),
+        countdown=NOTIFICATION_WINDOW - now % NOTIFICATION_WINDOW)
+    try:
+        yield task.add_async()
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        # The User is already notified in this window
+        pass
 
 
 @endpoints.api(name='battleship', version='v1')
@@ -43,13 +94,15 @@ class BattleshipApi(remote.Service):
                       path='user',
                       name='create_user',
                       http_method='POST')
+    @instrumented
     def create_user(self, request):
         """Create a User. Requires a unique username"""
-        if User.query(User.name == request.user_name).get():
+        repository = get_repository()
+        if repository.get_user_key(request.user_name):
             raise endpoints.ConflictException(
                 'A User with that name already exists!')
-        user = User(name=request.user_name, email=request.email)
-        user.put()
+        repository.add_user(User(name=request.user_name,
+                                 email=request.email))
         return StringMessage(message='User {} created!'.format(
             request.user_name))
 
@@ -58,93 +111,245 @@ class BattleshipApi(remote.Service):
                       path='game',
                       name='new_game',
                       http_method='POST')
+    @instrumented
     def new_game(self, request):
         """Creates new game"""
-        user1 = User.query(User.name == request.player1_name).get()
-        if not user1:
+        repository = get_repository()
+        user1key = repository.get_user_key(request.player1_name)
+        if not user1key:
             raise endpoints.NotFoundException(
                 'User 1 does not exist!')
-        user2 = User.query(User.name == request.player2_name).get()
-        if not user2:
-            user2key = user2
-        else:
-            user2key = user2.key
+        user2key = repository.get_user_key(request.player2_name)
 
-        player1_primary_grid = GameLogic.place_ship_on_grid(
-                                request,
-                                '1')
-        player2_primary_grid = GameLogic.place_ship_on_grid(
-                                request,
-                                '2')
-        player1_tracking_grid = GameLogic.create_default_grid()
-        player2_tracking_grid = GameLogic.create_default_grid()
+        player1_board = GameLogic.place_ship_on_grid(request, '1')
+        player2_board = GameLogic.place_ship_on_grid(request, '2')
 
-        game = Game.new_game(user1.key, user2key,
-                             player1_primary_grid,
-                             player2_primary_grid,
-                             player1_tracking_grid,
-                             player2_tracking_grid)
+        game = Game.new_game(user1key, user2key,
+                             player1_board,
+                             player2_board)
+        game.key = repository.allocate_key(Game)
+        repository.put_game_async(game).get_result()
+        cache_game_async(game).get_result()
 
-        return game.to_form('Good luck playing Battleship!')
+        names = {user1key: request.player1_name}
+        if user2key:
+            names[user2key] = request.player2_name
+        return game.to_form('Good luck playing Battleship!', names)
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}',
                       name='get_game',
                       http_method='GET')
+    @instrumented
     def get_game(self, request):
         """Return the current game state."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        repository = get_repository()
+        game = repository.get_game_async(request.urlsafe_game_key).get_result()
         if game:
+            names = repository.get_user_names(game.user_keys())
             if game.game_over:
-                return game.to_game_over_form('Game already over!')
+                # Only the grids of a game over need its boards
+                repository.load_boards_async(game).get_result()
+                return game.to_game_over_form('Game already over!', names,
+                                              request.compact)
             else:
-                return game.to_form('Time to make a move!')
+                return game.to_form('Time to make a move!', names)
         else:
             raise endpoints.NotFoundException('Game not found!')
 
+    @endpoints.method(request_message=GAME_UPDATES_REQUEST,
+                      response_message=GameUpdateForm,
+                      path='game/{urlsafe_game_key}/updates',
+                      name='get_game_updates',
+                      http_method='GET')
+    @instrumented
+    def get_game_updates(self, request):
+        """Returns the moves made since the version of the game the client
+        has, or just that it is unchanged. Meant for polling: when the
+        version is the latest the answer comes from memcache"""
+        key = key_from_urlsafe(request.urlsafe_game_key)
+        if get_game_version(key) == request.version:
+            return GameUpdateForm(version=request.version, unchanged=True)
+
+        repository = get_repository()
+        game = repository.get_game_async(request.urlsafe_game_key,
+                                         boards=True).get_result()
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        if request.version == game.version:
+            return GameUpdateForm(version=game.version, unchanged=True)
+        if not 0 <= request.version < game.version:
+            raise endpoints.BadRequestException('Unknown version')
+        names = repository.get_user_names(game.user_keys())
+        return game.to_update_form(request.version, names)
+
     @endpoints.method(request_message=MAKE_MOVE_REQUEST,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}',
                       name='make_move',
                       http_method='PUT')
+    @instrumented
     def make_move(self, request):
         """Makes a move. Returns a game state with message"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        if game.game_over:
-            return game.to_game_over_form('Game already over!')
+        return self._make_move_async(request).get_result()
+
+    @ndb.tasklet
+    def _make_move_async(self, request):
+        repository = get_repository()
+        game, moved, form = yield repository.transaction_async(
+            lambda: self._apply_one_move_async(request, repository))
+        if moved:
+            futures = [cache_game_async(game)]
+            if not game.game_over and game.player2 is not None:
+                # Send a reminder email to opponent, at most one per window
+                futures.append(_notify_player_async(game.current_player))
+            # The enqueue runs alongside the caching, not after it
+            yield futures
+        raise ndb.Return(form)
+
+    @ndb.tasklet
+    def _apply_one_move_async(self, request, repository):
+        """Makes the move, to be run in a transaction"""
+        game = yield repository.get_game_async(request.urlsafe_game_key,
+                                               boards=True)
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        names = yield repository.get_user_names_async(game.user_keys())
+
+        message = self._check_move(game, request.is_player1_move)
+        if message:
+            raise ndb.Return((game, False, self._move_response_form(
+                game, message, request.is_player1_move, names,
+                request.compact)))
+
+        message = self._apply_move(game, request, names)
+        yield lock_game_version_async(game)
+
+        is_over, winner = GameLogic.get_winner(game)
+        if is_over:
+            winner_name = names.get(winner, 'Computer')
+            yield repository.end_game_async(game, winner, winner_name)
+            raise ndb.Return((game, True, game.to_game_over_form(
+                'Game over! %s wins!' % winner_name, names,
+                request.compact)))
+        yield repository.put_game_async(game)
+        raise ndb.Return((game, True, game.to_game_move_form(
+            message, request.is_player1_move, names, request.compact)))
+
+    @endpoints.method(request_message=MAKE_MOVES_REQUEST,
+                      response_message=MoveResultForms,
+                      path='game/{urlsafe_game_key}/moves',
+                      name='make_moves',
+                      http_method='PUT')
+    @instrumented
+    def make_moves(self, request):
+        """Makes a list of moves in order, stopping at the end of the game or
+        at the first move that cannot be made. The moves made are saved in
+        one transaction. Returns the result of each move tried and the final
+        game state"""
+        if not request.moves:
+            raise endpoints.BadRequestException('No moves given')
+        if len(request.moves) > MAX_BATCH_MOVES:
+            raise endpoints.BadRequestException(
+                'At most %d moves can be made at once' % MAX_BATCH_MOVES)
+        return self._make_moves_async(request).get_result()
+
+    @ndb.tasklet
+    def _make_moves_async(self, request):
+        repository = get_repository()
+        game, results, form = yield repository.transaction_async(
+            lambda: self._apply_moves_async(request, repository))
+        if results[0].applied:
+            futures = [cache_game_async(game)]
+            if not game.game_over and game.player2 is not None:
+                futures.append(_notify_player_async(game.current_player))
+            yield futures
+        raise ndb.Return(MoveResultForms(items=results, game=form))
+
+    @ndb.tasklet
+    def _apply_moves_async(self, request, repository):
+        """Makes the moves, to be run in a transaction"""
+        game = yield repository.get_game_async(request.urlsafe_game_key,
+                                               boards=True)
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        names = yield repository.get_user_names_async(game.user_keys())
+
+        results = []
+        for move in request.moves:
+            result = MoveResultForm(
+                move=str(move.move_row) + str(move.move_col), applied=False)
+            results.append(result)
+            is_player1_move = move.is_player1_move
+
+            result.message = self._check_move(game, is_player1_move)
+            if result.message:
+                break
+            try:
+                result.message = self._apply_move(game, move, names)
+            except endpoints.BadRequestException, e:
+                result.message = str(e)
+                break
+            if not results[0].applied:
+                yield lock_game_version_async(game)
+            result.applied = True
+
+            is_over, winner = GameLogic.get_winner(game)
+            if is_over:
+                winner_name = names.get(winner, 'Computer')
+                result.message = 'Game over! %s wins!' % winner_name
+                yield repository.end_game_async(game, winner, winner_name)
+                break
+
+        if results[0].applied and not game.game_over:
+            yield repository.put_game_async(game)
+        form = self._move_response_form(game, results[-1].message,
+                                        is_player1_move, names,
+                                        request.compact)
+        raise ndb.Return((game, results, form))
 
+    @staticmethod
+    def _check_move(game, is_player1_move):
+        """Returns why the player cannot move in the game, or None"""
+        if game.game_over:
+            return 'Game already over!'
         if game.cancelled:
-            return game.to_game_over_form('Game already cancelled!')
-
+            return 'Game already cancelled!'
         # Check if this move is from the correct player
-        if GameLogic.is_correct_player(game, request.is_player1_move) is False:
-            return game.to_game_move_form('It is not your turn!',
-                                          request.is_player1_move)
+        if GameLogic.is_correct_player(game, is_player1_move) is False:
+            return 'It is not your turn!'
 
+    @staticmethod
+    def _move_response_form(game, message, is_player1_move, names,
+                            compact=False):
+        if game.game_over or game.cancelled:
+            return game.to_game_over_form(message, names, compact)
+        return game.to_game_move_form(message, is_player1_move, names,
+                                      compact)
+
+    @staticmethod
+    def _apply_move(game, move, names):
+        """Applies a move to the game in memory and returns its message. The
+        turn passes to the opponent unless the move ends the game, and the
+        Computer makes its move if it is the opponent. Raises
+        endpoints.BadRequestException for an invalid move"""
         player_move, is_ship_hit, ship_being_hit, is_ship_destroyed = \
-            GameLogic.make_move(request, game)
+            GameLogic.make_move(move, game)
 
         # Decrease the ships remaining if the ship is hit
         GameLogic.set_new_ships_remaining(
-            game, is_ship_destroyed, request.is_player1_move)
+            game, is_ship_destroyed, move.is_player1_move)
 
-        if(request.is_player1_move):
+        if(move.is_player1_move):
             current_player = game.player1
             next_player = game.player2
         else:
             current_player = game.player2
             next_player = game.player1
 
-        if current_player is not None:
-            current_player_name = current_player.get().name
-        else:
-            current_player_name = 'Computer'
-
-        if next_player is not None:
-            next_player_name = next_player.get().name
-        else:
-            next_player_name = 'Computer'
+        current_player_name = names.get(current_player, 'Computer')
+        next_player_name = names.get(next_player, 'Computer')
 
         msg = '%s has hit the ' % current_player_name
         if is_ship_hit:
@@ -156,176 +361,177 @@ class BattleshipApi(remote.Service):
             msg += ' and sunk it'
 
         # Save move to game history
-        move = GameStepForm()
-        move.player = current_player_name
-        move.move = player_move
-        move.is_ship_destroyed = is_ship_destroyed
-        game.history.append(move)
+        game.add_move(move.is_player1_move,
+                      move.move_row.number * 10 + move.move_col - 1,
+                      is_ship_destroyed)
 
         # Update last move time
         game.last_move = datetime.now()
 
-        if game.player1_ships_remaining < 1 or \
-           game.player2_ships_remaining < 1:
-            if game.player1_ships_remaining < 1:
-                game.end_game(game.player2)
-                if game.player2 is not None:
-                    winner_name = game.player2.get().name
-                else:
-                    winner_name = 'Computer'
-            else:
-                game.end_game(game.player1)
-                if game.player1 is not None:
-                    winner_name = game.player1.get().name
-                else:
-                    winner_name = 'Computer'
-            return game.to_game_over_form('Game over! %s wins!' % winner_name)
-        else:
-            game.current_player = next_player
-            game.put()
-            # Send a reminder email to opponent upon each move
-            if game.current_player is not None:
-                taskqueue.add(
-                    url='/tasks/send_notification_to_opponent',
-                    params={'player_to_move': next_player_name})
-            return game.to_game_move_form('%s! %s\'s turn' % (
-                                          msg,
-                                          next_player_name
-                                          ), request.is_player1_move)
-
-    @endpoints.method(response_message=ScoreForms,
+        message = '%s! %s\'s turn' % (msg, next_player_name)
+        if GameLogic.get_winner(game)[0]:
+            return message
+        game.current_player = next_player
+
+        # The Computer replies straight away
+        if GameLogic.is_computer_turn(game):
+            message += ' ' + BattleshipApi._apply_move(
+                game, GameLogic.computer_move(game), names)
+        return message
+
+    @endpoints.method(request_message=LIST_REQUEST,
+                      response_message=ScoreForms,
                       path='scores',
                       name='get_scores',
                       http_method='GET')
+    @instrumented
     def get_scores(self, request):
-        """Return all scores"""
-        return ScoreForms(items=[score.to_form() for score in Score.query()])
+        """Return all scores, a page at a time"""
+        return self._score_forms(*get_repository().scores_page(
+            request.page_size, request.cursor))
 
-    @endpoints.method(request_message=USER_REQUEST,
+    @endpoints.method(request_message=USER_LIST_REQUEST,
                       response_message=ScoreForms,
                       path='scores/user/{user_name}',
                       name='get_user_scores',
                       http_method='GET')
+    @instrumented
     def get_user_scores(self, request):
-        """Returns all of an individual User's scores"""
-        user = User.query(User.name == request.user_name).get()
-        if not user:
+        """Returns all of an individual User's scores, a page at a time"""
+        repository = get_repository()
+        user_key = repository.get_user_key(request.user_name)
+        if not user_key:
             raise endpoints.NotFoundException(
                 'A User with that name does not exist!')
-        scores = Score.query(Score.winner == user.key)
-        return ScoreForms(items=[score.to_form() for score in scores])
+        return self._score_forms(*repository.scores_page(
+            request.page_size, request.cursor, winner=user_key))
 
-    @endpoints.method(request_message=USER_REQUEST,
+    @staticmethod
+    def _score_forms(scores, next_cursor):
+        names = get_repository().get_user_names(
+            [score.winner for score in scores])
+        return ScoreForms(items=Score.to_forms(scores, names),
+                          next_cursor=next_cursor)
+
+    @endpoints.method(request_message=USER_LIST_REQUEST,
                       response_message=GameForms,
                       path='game/user/{user_name}',
                       name='get_user_games',
                       http_method='GET')
+    @instrumented
     def get_user_games(self, request):
-        """Returns all of a User's active games"""
-        user = User.query(User.name == request.user_name).get()
-        if not user:
+        """Returns all of a User's active games, a page at a time"""
+        repository = get_repository()
+        user_key = repository.get_user_key(request.user_name)
+        if not user_key:
             raise endpoints.NotFoundException(
                 'A User with that name does not exist!')
-        games = Game.query(ndb.AND(Game.game_over == False,
-                                   Game.cancelled == False,
-                                   ndb.OR(Game.player1 == user.key,
-                                          Game.player2 == user.key)))
-        return GameForms(items=[game.to_form('') for game in games])
+        games, next_cursor = repository.active_games_page(
+            user_key, request.page_size, request.cursor)
+        names = repository.get_user_names(
+            [key for game in games for key in game.user_keys()])
+        return GameForms(items=Game.to_forms(games, '', names),
+                         next_cursor=next_cursor)
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=GameForm,
                       path='game',
                       name='cancel_game',
                       http_method='PUT')
+    @instrumented
     def cancel_game(self, request):
         """Cancel the game and return the current game state."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        if game:
-            if game.game_over:
-                return game.to_game_over_form('Game already over!')
-            elif game.cancelled:
-                return game.to_game_over_form('Game already cancelled!')
-            else:
-                game.cancelled = True
-                game.put()
-                return game.to_game_over_form('Game Cancelled!')
-        else:
+        repository = get_repository()
+        game, cancelled, form = repository.transaction_async(
+            lambda: self._cancel_game_async(request, repository)).get_result()
+        if cancelled:
+            cache_game_async(game).get_result()
+        return form
+
+    @ndb.tasklet
+    def _cancel_game_async(self, request, repository):
+        """Cancels the game, to be run in a transaction"""
+        game = yield repository.get_game_async(request.urlsafe_game_key,
+                                               boards=True)
+        if not game:
             raise endpoints.NotFoundException('Game not found!')
+        names = yield repository.get_user_names_async(game.user_keys())
+        if game.game_over:
+            raise ndb.Return((game, False, game.to_game_over_form(
+                'Game already over!', names, request.compact)))
+        elif game.cancelled:
+            raise ndb.Return((game, False, game.to_game_over_form(
+                'Game already cancelled!', names, request.compact)))
+        game.cancelled = True
+        yield lock_game_version_async(game)
+        yield repository.put_game_async(game)
+        raise ndb.Return((game, True, game.to_game_over_form(
+            'Game Cancelled!', names, request.compact)))
 
     @endpoints.method(request_message=GET_HIGHSCORE_REQUEST,
                       response_message=ScoreForms,
                       path='scores/highscore',
                       name='get_high_scores',
                       http_method='GET')
+    @instrumented
     def get_high_scores(self, request):
-        """Return all scores sorted by their ships remaining"""
-        scores = Score.query()
-        scores = scores.order(-Score.ships_remaining)
-        try:
-            scores = scores.fetch(request.number_of_results)
-        except:
-            raise endpoints.BadRequestException(
-                'Please put in a positive number')
-        return ScoreForms(items=[score.to_form() for score in scores])
-
-    @endpoints.method(response_message=RankForms,
+        """Return all scores sorted by their ships remaining, a page at a
+        time. number_of_results is accepted as the page size"""
+        page_size = request.page_size
+        if page_size is None:
+            page_size = request.number_of_results
+        return self._score_forms(*get_repository().scores_page(
+            page_size, request.cursor, best_first=True))
+
+    @endpoints.method(request_message=LIST_REQUEST,
+                      response_message=RankForms,
                       path='scores/ranking',
                       name='get_user_rankings',
                       http_method='GET')
+    @instrumented
     def get_user_rankings(self, request):
-        """Returns the ranking of users"""
-        scores = Score.query()
-        scores_grouped_by_user = {}
-
-        for score in scores:
-            name = score.winner.get().name
-            if name in scores_grouped_by_user:
-                scores_grouped_by_user[name] += score.ships_remaining
-            else:
-                scores_grouped_by_user[name] = score.ships_remaining
-
-        rankings = sorted(
-            scores_grouped_by_user.items(), key=operator.itemgetter(1))
-        rankings.reverse()
-
-        def make_rank_form(score):
-            form = RankForm()
-            form.user = score[0]
-            form.score = score[1]
-            return form
-
-        return RankForms(items=[make_rank_form(score) for score in rankings])
+        """Returns the ranking of users, a page at a time"""
+        rankings, next_cursor = get_repository().rankings_page(
+            request.page_size, request.cursor)
+        return RankForms(items=[ranking.to_form() for ranking in rankings],
+                         next_cursor=next_cursor)
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=GameStepForms,
                       path='game/{urlsafe_game_key}/history',
                       name='get_game_history',
                       http_method='GET')
+    @instrumented
     def get_game_history(self, request):
         """Return the history of game in an array of moves"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        repository = get_repository()
+        game = repository.get_game_async(request.urlsafe_game_key).get_result()
         if game:
-            return GameStepForms(items=[GameStepForm(
-                                 player=step.player,
-                                 move=step.move,
-                                 is_ship_destroyed=step.is_ship_destroyed)
-                                 for step in game.history])
+            names = repository.get_user_names(game.user_keys())
+            return GameStepForms(items=game.to_step_forms(names))
         else:
             raise endpoints.NotFoundException('Game not found!')
 
     @staticmethod
-    def _get_dormant_games():
-        """Return the games with last move time later than 12 hours"""
-        dormant_games = []
-        games = Game.query(ndb.AND(Game.game_over == False,
-                                   Game.cancelled == False))
-        for game in games:
-            elapsedTime = datetime.now() - game.last_move
-            elaspedHours, elaspedSeconds = divmod(
-                elapsedTime.days * 86400 + elapsedTime.seconds, 3600)
-            if elaspedHours >= 12:
-                dormant_games.append(game)
-
-        return dormant_games
-
-api = endpoints.api_server([BattleshipApi])
+    def _get_dormant_games(cutoff, start_cursor=None,
+                           batch_size=DORMANT_BATCH_SIZE):
+        """Return a batch of the active games whose last move is older than
+        cutoff, with the cursor of the next batch and whether there are more.
+        Only the players are projected, the games are not loaded"""
+        games = Game.query(Game.game_over == False,
+                           Game.cancelled == False,
+                           Game.last_move <= cutoff)
+        return games.fetch_page(batch_size, start_cursor=start_cursor,
+                                projection=DORMANT_GAME_PROJECTION)
+
+    @staticmethod
+    def _get_user_dormant_games(user_key, cutoff):
+        """Return the active games whose last move is older than cutoff and
+        where it is the turn of the User. Only the players are projected"""
+        games = Game.query(Game.game_over == False,
+                           Game.cancelled == False,
+                           Game.current_player == user_key,
+                           Game.last_move <= cutoff)
+        return games.fetch(projection=USER_DORMANT_GAME_PROJECTION)
+
+api = StatsMiddleware(endpoints.api_server([BattleshipApi]))
@@ -0,0 +1,300 @@
+"""board.py - Bitboard representation of a player's fleet. Every cell of the
+10x10 grid maps to one bit (row * 10 + col) of an integer, so hit tests,
+overlap checks and sunk detection are single bitwise operations. This module
+has no App Engine dependencies."""
+
+import binascii
+import random
+import struct
+
+GRID_SIZE = 10
+CELL_COUNT = GRID_SIZE * GRID_SIZE
+WATER = '~'
+SHOT = 'x'
+
+# Ship codes in a fixed order, used wherever a board is serialized
+SHIP_CODES = ('ac', 'bs', 'sm', 'dt', 'pb')
+SHIP_SIZES = {'ac': 5, 'bs': 4, 'sm': 3, 'dt': 3, 'pb': 2}
+# One character per ship, for the compact string form of the grids
+SHIP_CHARS = dict((shipcode, shipcode[0]) for shipcode in SHIP_CODES)
+
+CELL_BITS = [1 << i for i in range(CELL_COUNT)]
+
+# Packed board format: a version byte, then for each board one mask per ship
+# in SHIP_CODES order followed by the shots mask, each MASK_BYTES big endian
+BOARD_FORMAT_VERSION = 1
+MASK_BYTES = (CELL_COUNT + 7) // 8
+BOARD_BYTES = MASK_BYTES * (len(SHIP_CODES) + 1)
+
+# Packed move log: a version byte, then two bytes per move, big endian, with
+# the cell shot in the low 7 bits, whether it sunk a ship in bit 7 and the
+# player (set for player 2) in bit 8
+MOVE_LOG_VERSION = 1
+MOVE_BYTES = 2
+MOVE_CELL_MASK = 0x7f
+MOVE_SUNK_FLAG = 1 << 7
+MOVE_PLAYER2_FLAG = 1 << 8
+ROW_NAMES = 'ABCDEFGHIJ'
+
+
+def cell_bit(row, col):
+    """Returns the bit of the cell at row, col (both 0 based)"""
+    return CELL_BITS[row * GRID_SIZE + col]
+
+
+def ship_mask(row, col, size, is_horizontal):
+    """Returns the mask covered by a ship starting at row, col. The caller is
+    responsible for checking that the ship fits in the grid"""
+    if is_horizontal:
+        return ((1 << size) - 1) << (row * GRID_SIZE + col)
+    mask = 0
+    for i in range(size):
+        mask |= CELL_BITS[(row + i) * GRID_SIZE + col]
+    return mask
+
+
+def popcount(mask):
+    return bin(mask).count('1')
+
+
+def mask_cells(mask):
+    """Generates the index of every cell in mask"""
+    while mask:
+        bit = mask & -mask
+        yield bit.bit_length() - 1
+        mask ^= bit
+
+
+def _placements(size):
+    masks = []
+    for row in range(GRID_SIZE):
+        for col in range(GRID_SIZE - size + 1):
+            masks.append(ship_mask(row, col, size, True))
+    for row in range(GRID_SIZE - size + 1):
+        for col in range(GRID_SIZE):
+            masks.append(ship_mask(row, col, size, False))
+    return masks
+
+# Mask of every legal placement of a ship on an empty grid, by ship size
+PLACEMENTS = dict((size, _placements(size))
+                  for size in set(SHIP_SIZES.itervalues()))
+
+
+class Board(object):
+    """The fleet of one player together with the shots the opponent has
+    fired at it"""
+    __slots__ = ('ships', 'fleet', 'shots', 'hits')
+
+    def __init__(self, ships=None, shots=0):
+        self.ships = {}
+        self.fleet = 0
+        for shipcode, mask in (ships or {}).iteritems():
+            self.ships[shipcode] = mask
+            self.fleet |= mask
+        self.shots = shots
+        self.hits = shots & self.fleet
+
+    def place(self, shipcode, mask):
+        """Places a ship on the board. Returns False without placing it if
+        it overlaps another ship"""
+        if self.fleet & mask:
+            return False
+        self.ships[shipcode] = mask
+        self.fleet |= mask
+        return True
+
+    def shoot(self, bit):
+        """Marks the cell as shot. Returns the code of the ship being hit, or
+        None if nothing is hit"""
+        self.shots |= bit
+        if not self.fleet & bit:
+            return None
+        self.hits |= bit
+        for shipcode, mask in self.ships.iteritems():
+            if mask & bit:
+                return shipcode
+
+    def is_sunk(self, shipcode):
+        return not self.ships[shipcode] & ~self.shots
+
+    def remaining(self, shipcode):
+        """Returns the number of cells of the ship not hit yet"""
+        return popcount(self.ships[shipcode] & ~self.shots)
+
+    def ships_remaining(self):
+        return sum(1 for shipcode in self.ships if not self.is_sunk(shipcode))
+
+    def _ship_at(self, bit):
+        for shipcode, mask in self.ships.iteritems():
+            if mask & bit:
+                return shipcode
+        return WATER
+
+    def to_primary_grid(self):
+        """Returns the board as seen by its owner: ship codes, with every
+        shot cell marked 'x'"""
+        grid = []
+        for row in range(GRID_SIZE):
+            cells = []
+            for col in range(GRID_SIZE):
+                bit = CELL_BITS[row * GRID_SIZE + col]
+                if self.shots & bit:
+                    cells.append(SHOT)
+                elif self.fleet & bit:
+                    cells.append(self._ship_at(bit))
+                else:
+                    cells.append(WATER)
+            grid.append(cells)
+        return grid
+
+    def to_tracking_grid(self):
+        """Returns the board as seen by the opponent: the ship code for every
+        hit, 'x' for every miss"""
+        return [[self.tracking_cell(CELL_BITS[row * GRID_SIZE + col])
+                 for col in range(GRID_SIZE)]
+                for row in range(GRID_SIZE)]
+
+    def to_primary_string(self):
+        """Returns the primary grid as a string of CELL_COUNT characters, row
+        by row, with SHIP_CHARS for the ship codes"""
+        cells = [WATER] * CELL_COUNT
+        for shipcode, mask in self.ships.iteritems():
+            for cell in mask_cells(mask & ~self.shots):
+                cells[cell] = SHIP_CHARS[shipcode]
+        for cell in mask_cells(self.shots):
+            cells[cell] = SHOT
+        return ''.join(cells)
+
+    def to_tracking_string(self):
+        """Returns the tracking grid of the opponent in the format of
+        to_primary_string"""
+        cells = [WATER] * CELL_COUNT
+        for cell in mask_cells(self.shots & ~self.fleet):
+            cells[cell] = SHOT
+        for shipcode, mask in self.ships.iteritems():
+            for cell in mask_cells(mask & self.shots):
+                cells[cell] = SHIP_CHARS[shipcode]
+        return ''.join(cells)
+
+    def tracking_cell(self, bit):
+        """Returns the cell as the tracking grid of the opponent shows it"""
+        if self.hits & bit:
+            return self._ship_at(bit)
+        if self.shots & bit:
+            return SHOT
+        return WATER
+
+    def to_bytes(self):
+        """Returns the board packed into BOARD_BYTES bytes"""
+        masks = [self.ships.get(shipcode, 0) for shipcode in SHIP_CODES]
+        masks.append(self.shots)
+        return binascii.unhexlify(
+            ''.join('%0*x' % (MASK_BYTES * 2, mask) for mask in masks))
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Builds a Board from the output of to_bytes"""
+        masks = [int(binascii.hexlify(data[i:i + MASK_BYTES]), 16)
+                 for i in range(0, BOARD_BYTES, MASK_BYTES)]
+        ships = {}
+        for shipcode, mask in zip(SHIP_CODES, masks):
+            if mask:
+                ships[shipcode] = mask
+        return cls(ships, masks[-1])
+
+    @classmethod
+    def from_grids(cls, primary_grid, tracking_grid):
+        """Builds a Board from the primary grid of its owner and the tracking
+        grid of the opponent. A hit cell is 'x' on the primary grid, so the
+        ship code is recovered from the tracking grid"""
+        ships = {}
+        shots = 0
+        for row in range(GRID_SIZE):
+            for col in range(GRID_SIZE):
+                bit = CELL_BITS[row * GRID_SIZE + col]
+                shipcode = primary_grid[row][col]
+                if shipcode == SHOT:
+                    shots |= bit
+                    shipcode = tracking_grid[row][col]
+                if shipcode not in (WATER, SHOT):
+                    ships[shipcode] = ships.get(shipcode, 0) | bit
+        return cls(ships, shots)
+
+
+def pack_boards(boards):
+    """Packs a sequence of Boards into a versioned byte string"""
+    return chr(BOARD_FORMAT_VERSION) + \
+        ''.join(board.to_bytes() for board in boards)
+
+
+def unpack_boards(data):
+    """Returns the list of Boards packed by pack_boards"""
+    version = ord(data[0])
+    if version != BOARD_FORMAT_VERSION:
+        raise ValueError('Unknown board format version %d' % version)
+    return [Board.from_bytes(data[i:i + BOARD_BYTES])
+            for i in range(1, len(data), BOARD_BYTES)]
+
+
+def new_move_log():
+    """Returns an empty move log"""
+    return chr(MOVE_LOG_VERSION)
+
+
+def pack_move(is_player1_move, cell, is_sunk):
+    """Returns the MOVE_BYTES of a move, to be appended to a move log"""
+    value = cell
+    if is_sunk:
+        value |= MOVE_SUNK_FLAG
+    if not is_player1_move:
+        value |= MOVE_PLAYER2_FLAG
+    return struct.pack('>H', value)
+
+
+def unpack_moves(data, start=0):
+    """Generates the moves of a move log from the move at index start, as
+    tuples of whether player 1 made the move, the cell shot and whether it
+    sunk a ship"""
+    version = ord(data[0])
+    if version != MOVE_LOG_VERSION:
+        raise ValueError('Unknown move log version %d' % version)
+    for i in range(1 + start * MOVE_BYTES, len(data), MOVE_BYTES):
+        value, = struct.unpack('>H', data[i:i + MOVE_BYTES])
+        yield not value & MOVE_PLAYER2_FLAG, value & MOVE_CELL_MASK, \
+            bool(value & MOVE_SUNK_FLAG)
+
+
+def move_count(data):
+    """Returns the number of moves in a move log"""
+    return (len(data) - 1) // MOVE_BYTES
+
+
+def move_name(cell):
+    """Returns the name of a cell as the players see it, e.g. 'A10'"""
+    row, col = divmod(cell, GRID_SIZE)
+    return '%s%d' % (ROW_NAMES[row], col + 1)
+
+
+def move_cell(name):
+    """Returns the cell of a name returned by move_name"""
+    return ROW_NAMES.index(name[0]) * GRID_SIZE + int(name[1:]) - 1
+
+
+def random_fleet(rand=random):
+    """Returns a Board holding a uniformly random valid fleet. Every ship gets
+    a random placement of its size, and the whole fleet is drawn again if any
+    two overlap, so that every valid fleet is equally likely"""
+    while True:
+        board = Board()
+        for shipcode in SHIP_CODES:
+            mask = rand.choice(PLACEMENTS[SHIP_SIZES[shipcode]])
+            if not board.place(shipcode, mask):
+                break
+        else:
+            return board
+
+
+def random_fleets(count, rand=random):
+    """Generates count Boards with random fleets"""
+    for _ in xrange(count):
+        yield random_fleet(rand)
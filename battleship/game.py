@@ -3,8 +3,10 @@
 import logging
 from google.appengine.ext import ndb
 import endpoints
+from ai import choose_shot
+from board import Board, GRID_SIZE, cell_bit, ship_mask, random_fleet
 from models import StringMessage, NewGameForm, GameForm, MakeMoveForm,\
-     GameForms
+     GameForms, GridRowNum
 
 
 class GameLogic():
@@ -39,7 +41,12 @@ class GameLogic():
 
     @classmethod
     def place_ship_on_grid(self, request, player):
-        grid = self.create_default_grid()
+        """Returns a Board with the ships of player placed as requested, or
+        at random if auto place is set for the player"""
+        if getattr(request, 'player%s_auto_place' % player):
+            return random_fleet()
+
+        board = Board()
 
         for shipcode, ship in self.ships.iteritems():
             start_row = \
@@ -47,12 +54,18 @@ class GameLogic():
                         'player%s_%s_start_row' % (player, ship['name']))
             start_col = \
                 getattr(request,
-                        'player%s_%s_start_col' % (player, ship['name'])) - 1
+                        'player%s_%s_start_col' % (player, ship['name']))
             is_horizontal = \
                 getattr(request,
                         'player%s_%s_is_horizontal' % (player, ship['name']))
-            start_row_dict = start_row.to_dict()
-            start_row = start_row_dict[str(start_row)]
+
+            if start_row is None or start_col is None or \
+               is_horizontal is None:
+                raise endpoints.BadRequestException(
+                    'The position of the %s of player %s is missing' %
+                    (ship['name'], player))
+            start_row = start_row.number
+            start_col -= 1
 
             if start_col < 0 or start_col >= 10:
                 raise endpoints.BadRequestException(
@@ -67,86 +80,49 @@ class GameLogic():
                 raise endpoints.BadRequestException(
                     'The %s of player %s is too tall' % (ship['name'], player))
 
-            for i in range(ship['size']):
-                col = start_col
-                row = start_row
-                if is_horizontal:
-                    col = start_col + i
-                else:
-                    row = start_row + i
-                if grid[row][col] != '~':
-                    raise endpoints.BadRequestException(
-                       'The %s of player %s is overlapping with another ship' %
-                       (ship['name'], player))
-
-                grid[row][col] = str(shipcode)
+            mask = ship_mask(start_row, start_col, ship['size'], is_horizontal)
+            if not board.place(shipcode, mask):
+                raise endpoints.BadRequestException(
+                   'The %s of player %s is overlapping with another ship' %
+                   (ship['name'], player))
 
-        return grid
+        return board
 
     @classmethod
     def make_move(self, request, game):
-        move_row = getattr(request, 'move_row')
-        move_col = getattr(request, 'move_col')
-        is_player1_move = getattr(request, 'is_player1_move')
-
-        player_move = str(move_row) + str(move_col)
+        is_player1_move = request.is_player1_move
+        player_move = str(request.move_row) + str(request.move_col)
 
-        move_col = move_col - 1
-        move_row_dict = move_row.to_dict()
-        move_row = move_row_dict[str(move_row)]
+        move_row = request.move_row.number
+        move_col = request.move_col - 1
 
         if move_col < 0 or move_col >= 10:
             raise endpoints.BadRequestException(
                 'move_col must be between 1 to 10')
 
-        if request.is_player1_move:
-            player = '1'
+        if is_player1_move:
             opponent = '2'
         else:
-            player = '2'
             opponent = '1'
 
-        is_ship_hit = False
-        is_ship_destroyed = False
-        ship_being_hit = ''
-        target_grid = getattr(game, 'player%s_primary_grid' % opponent)
-        tracking_grid = getattr(game, 'player%s_tracking_grid' % player)
-        hit_target = target_grid[move_row][move_col]
+        target_board = game.get_board(opponent)
+        bit = cell_bit(move_row, move_col)
 
-        if hit_target == 'x':
+        if target_board.shots & bit:
             raise endpoints.BadRequestException(
                 'You have hit this square already!')
 
-        if hit_target != '~':
-            is_ship_hit = True
-            ship_being_hit = self.ships[hit_target]['name']
-            tracking_grid[move_row][move_col] = hit_target
-        else:
-            tracking_grid[move_row][move_col] = 'x'
-
-        target_grid[move_row][move_col] = 'x'
-
-        if is_ship_hit is True:
-            for shipcode, ship in self.ships.iteritems():
-                if hit_target == shipcode:
-                    hit_target_remaining = getattr(game,
-                                                   'player%s_%s_remaining' %
-                                                   (opponent, ship['name']))
-                    if hit_target_remaining == 1:
-                        hit_target_remaining = 0
-                        setattr(game,
-                                'player%s_%s_remaining' %
-                                (opponent, ship['name']),
-                                hit_target_remaining)
-                        is_ship_destroyed = True
-                    else:
-                        hit_target_remaining -= 1
-                        setattr(game,
-                                'player%s_%s_remaining' %
-                                (opponent, ship['name']),
-                                hit_target_remaining)
-
-        return player_move, is_ship_hit, ship_being_hit, is_ship_destroyed
+        hit_target = target_board.shoot(bit)
+        if hit_target is None:
+            return player_move, False, '', False
+
+        ship = self.ships[hit_target]
+        setattr(game,
+                'player%s_%s_remaining' % (opponent, ship['name']),
+                target_board.remaining(hit_target))
+
+        return player_move, True, ship['name'], \
+            target_board.is_sunk(hit_target)
 
     @classmethod
     def is_correct_player(self, game, is_player1_move):
@@ -155,6 +131,28 @@ class GameLogic():
         else:
             return game.current_player == game.player2
 
+    @classmethod
+    def is_computer_turn(self, game):
+        return game.player2 is None and game.current_player is None
+
+    @classmethod
+    def computer_move(self, game):
+        """Returns the Computer's next move against player 1"""
+        cell = choose_shot(game.get_board('1'))
+        return MakeMoveForm(is_player1_move=False,
+                            move_row=GridRowNum(cell // GRID_SIZE),
+                            move_col=cell % GRID_SIZE + 1)
+
+    @classmethod
+    def get_winner(self, game):
+        """Returns whether the game is over and the key of the winner, None
+        when the Computer wins"""
+        if game.player1_ships_remaining < 1:
+            return True, game.player2
+        if game.player2_ships_remaining < 1:
+            return True, game.player1
+        return False, None
+
     @classmethod
     def set_new_ships_remaining(self,
                                 game,
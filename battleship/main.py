@@ -2,48 +2,149 @@
 
 """main.py - This file contains handlers that are called by taskqueue and/or
 cronjobs."""
+import json
 import logging
+from datetime import datetime, timedelta
 
 import webapp2
-from google.appengine.api import mail, app_identity
+from google.appengine.api import mail, app_identity, memcache, taskqueue
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
-from api import BattleshipApi
+from api import BattleshipApi, DORMANT_HOURS
 
-from models import User
+from models import Game, Score, Ranking
+from utils import get_user_key, lock_game_version_async, cache_game_async
+import stats
+
+CUTOFF_FORMAT = '%Y-%m-%d %H:%M:%S'
+MIGRATION_BATCH_SIZE = 100
+# Scores added to a Ranking per transaction, each Score being its own
+# entity group
+RANKING_TRANSACTION_SIZE = 20
 
 
 class SendReminderEmail(webapp2.RequestHandler):
     def get(self):
         """Send a reminder email to each User who has not moved 12 hours after
         their opponents moved in every dormant game. Checked every hour using
-        a cron job"""
+        a cron job, which starts a chain of SendReminderEmailBatch tasks"""
+        cutoff = datetime.now() - timedelta(hours=DORMANT_HOURS)
+        taskqueue.add(url='/tasks/send_reminders',
+                      params={'cutoff': cutoff.strftime(CUTOFF_FORMAT)})
+
+
+def _reminder_task_name(run, user_key):
+    """Names the digest task of a User in a run, so that it is enqueued once
+    whatever the number of batches the games of the User span"""
+    return 'remind-%s-%s' % (run.replace(' ', '-').replace(':', '-'),
+                             user_key.id())
+
+
+class SendReminderEmailBatch(webapp2.RequestHandler):
+    def post(self):
+        """Enqueue a digest task for each User whose turn it is in a batch of
+        dormant games, then chain a task for the next batch. See
+        SendUserReminderEmail"""
+        run = self.request.get('cutoff')
+        cutoff = datetime.strptime(run, CUTOFF_FORMAT)
+        cursor = self.request.get('cursor')
+        if cursor:
+            cursor = Cursor(urlsafe=cursor)
+        dormant_games, next_cursor, more = \
+            BattleshipApi._get_dormant_games(cutoff, cursor or None)
+
+        # Computer's turn in the games with no current player
+        user_keys = set(dormant_game.current_player
+                        for dormant_game in dormant_games
+                        if dormant_game.current_player is not None)
+        tasks = [taskqueue.Task(url='/tasks/send_user_reminder',
+                                params={'cutoff': run,
+                                        'user_key': user_key.urlsafe()},
+                                name=_reminder_task_name(run, user_key))
+                 for user_key in user_keys]
+        if tasks:
+            try:
+                taskqueue.Queue().add(tasks)
+            except (taskqueue.TaskAlreadyExistsError,
+                    taskqueue.TombstonedTaskError):
+                # Enqueued for an earlier batch, or by this one before a
+                # retry. The other tasks are added all the same
+                pass
+
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/send_reminders',
+                          params={'cutoff': run,
+                                  'cursor': next_cursor.urlsafe()})
+
+
+class SendUserReminderEmail(webapp2.RequestHandler):
+    def post(self):
+        """Send one digest email to a User of all the dormant games where it
+        is their turn. The User is marked reminded for the run once the
+        email is sent, so that a failed send is retried with the task but a
+        task run twice sends once"""
         app_id = app_identity.get_application_id()
-        dormant_games = BattleshipApi._get_dormant_games()
-
-        for dormant_game in dormant_games:
-            if dormant_game.current_player is not None:
-                user = dormant_game.current_player.get()
-                if dormant_game.player1.get().name == user.name:
-                    if dormant_game.player2 is not None:
-                        another_user_name = dormant_game.player2.get().name
-                    else:
-                        another_user_name = 'Computer'
-                else:
-                    another_user_name = user.name
-                subject = 'This is a reminder!'
-                body = 'Hey {}, you have not made a move for a long time, {} is falling asleep!'.format(user.name, another_user_name)
-                mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
-                               user.email,
-                               subject,
-                               body)
+        run = self.request.get('cutoff')
+        cutoff = datetime.strptime(run, CUTOFF_FORMAT)
+        user_key = ndb.Key(urlsafe=self.request.get('user_key'))
+        reminded = 'reminded:%s:%s' % (run, user_key.id())
+        if memcache.get(reminded):
+            return
+        user = user_key.get()
+        if user is None or not user.email:
+            return
+        games = BattleshipApi._get_user_dormant_games(user_key, cutoff)
+        if not games:
+            return
+
+        opponent_keys = set()
+        for game in games:
+            opponent_keys.update([game.player1, game.player2])
+        opponent_keys.discard(None)
+        opponent_keys.discard(user_key)
+        opponents = dict((opponent.key, opponent) for opponent in
+                         ndb.get_multi(list(opponent_keys))
+                         if opponent is not None)
+
+        opponent_names = []
+        for game in games:
+            if game.player1 == user_key:
+                opponent = opponents.get(game.player2)
+            else:
+                opponent = opponents.get(game.player1)
+            if opponent is not None:
+                opponent_names.append(opponent.name)
+            else:
+                opponent_names.append('Computer')
+
+        subject = 'This is a reminder!'
+        if len(games) == 1:
+            body = 'Hey {}, you have not made a move for a long time, ' \
+                '{} is falling asleep!'.format(user.name, opponent_names[0])
+        else:
+            body = 'Hey {}, you have not made a move for a long time ' \
+                'in {} games, {} are falling asleep!'.format(
+                    user.name, len(games), ', '.join(opponent_names))
+        mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
+                       user.email,
+                       subject,
+                       body)
+        memcache.set(reminded, 1, time=DORMANT_HOURS * 3600)
 
 
 class SendNoticationEmailToOpponent(webapp2.RequestHandler):
     def post(self):
         """Send Notication Email To Opponent"""
         app_id = app_identity.get_application_id()
-        player_to_move = self.request.get('player_to_move')
-        user = User.query(User.name == player_to_move).get()
+        user_key = self.request.get('user_key')
+        if user_key:
+            user_key = ndb.Key(urlsafe=user_key)
+        else:
+            # Tasks enqueued before notifications were keyed by User
+            user_key = get_user_key(self.request.get('player_to_move'))
+        user = user_key.get() if user_key else None
+        if user is None or not user.email:
+            return
         subject = 'This is a reminder!'
         body = 'Hey {}, it\'s your turn!'.format(user.name)
         mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
@@ -52,7 +153,116 @@ class SendNoticationEmailToOpponent(webapp2.RequestHandler):
                        body)
 
 
+@ndb.transactional(xg=True)
+def _migrate_game(key):
+    """Rewrites the Game of key if it still needs migrating. It is read again
+    in the transaction, so that a move made since it was listed is not
+    overwritten. Returns the Game, or None if there was nothing to do"""
+    game = key.get()
+    if game is None or not game.needs_migration():
+        return None
+    if game.has_boards():
+        game.get_board('1')
+    lock_game_version_async(game).get_result()
+    ndb.put_multi(game.entities())
+    return game
+
+
+class MigrateGameBoards(webapp2.RequestHandler):
+    def post(self):
+        """Rewrite a batch of games still storing their boards or pickled
+        history in the Game, with the boards in GameBoards and the history
+        in the packed move log format, or in progress without their active
+        players, then chain a task for the next batch"""
+        cursor = self.request.get('cursor')
+        if cursor:
+            cursor = Cursor(urlsafe=cursor)
+        games, next_cursor, more = Game.query().fetch_page(
+            MIGRATION_BATCH_SIZE, start_cursor=cursor or None)
+
+        migrated = 0
+        for game in games:
+            if not game.needs_migration():
+                continue
+            game = _migrate_game(game.key)
+            if game is not None:
+                cache_game_async(game).get_result()
+                migrated += 1
+        logging.info('Migrated %d games', migrated)
+
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/migrate_game_boards',
+                          params={'cursor': next_cursor.urlsafe()})
+
+    get = post
+
+
+class BuildRankings(webapp2.RequestHandler):
+    def post(self):
+        """Add a batch of Scores written before Rankings existed to their
+        winners' Rankings, then chain a task for the next batch"""
+        cursor = self.request.get('cursor')
+        if cursor:
+            cursor = Cursor(urlsafe=cursor)
+        scores, next_cursor, more = Score.query().fetch_page(
+            MIGRATION_BATCH_SIZE, start_cursor=cursor or None)
+
+        scores_by_winner = {}
+        for score in scores:
+            if not score.ranked:
+                scores_by_winner.setdefault(score.winner, []).append(score)
+
+        for winner, winner_scores in scores_by_winner.iteritems():
+            for i in range(0, len(winner_scores), RANKING_TRANSACTION_SIZE):
+                _add_to_ranking(
+                    winner,
+                    [score.key for score in
+                     winner_scores[i:i + RANKING_TRANSACTION_SIZE]])
+
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/build_rankings',
+                          params={'cursor': next_cursor.urlsafe()})
+
+    get = post
+
+
+class ShowStats(webapp2.RequestHandler):
+    def get(self):
+        """Show the request count, errors and latency, RPC and response size
+        histograms of each endpoints method over the last minutes (all the
+        windows kept by default). With traces=1, also show the sampled
+        request traces of the instance serving this request"""
+        try:
+            minutes = int(self.request.get('minutes') or stats.WINDOWS)
+        except ValueError:
+            minutes = 0
+        if minutes < 1:
+            self.abort(400, 'minutes must be a positive number')
+        result = {'minutes': min(minutes, stats.WINDOWS),
+                  'endpoints': stats.get_summary(minutes)}
+        if self.request.get('traces'):
+            result['traces'] = stats.get_traces()
+        self.response.content_type = 'application/json'
+        self.response.write(json.dumps(result, indent=2, sort_keys=True))
+
+
+@ndb.transactional(xg=True)
+def _add_to_ranking(winner, score_keys):
+    scores = [score for score in ndb.get_multi(score_keys)
+              if not score.ranked]
+    if scores:
+        ranking = Ranking.add_scores(winner, scores)
+        for score in scores:
+            score.ranked = True
+        ndb.put_multi(scores + [ranking])
+
+
 app = webapp2.WSGIApplication([
     ('/crons/send_reminder', SendReminderEmail),
+    ('/tasks/send_reminders', SendReminderEmailBatch),
+    ('/tasks/send_user_reminder', SendUserReminderEmail),
     ('/tasks/send_notification_to_opponent', SendNoticationEmailToOpponent),
+    ('/tasks/migrate_game_boards', MigrateGameBoards),
+    ('/tasks/build_rankings', BuildRankings),
+    ('/admin/stats', ShowStats),
 ], debug=True)
@@ -6,8 +6,28 @@ import random
 from datetime import date
 from protorpc import messages, message_types
 from google.appengine.ext import ndb
+from board import Board, CELL_BITS, pack_boards, unpack_boards,\
+    new_move_log, pack_move, unpack_moves, move_count, move_name, move_cell
 
 DEFAULT_SHIPS = 5
+PLAYERS = ('1', '2')
+# Ship names in board.SHIP_CODES order, the order of the compact counters
+SHIP_NAMES = ('aircraft_carrier', 'battleship', 'submarine', 'destroyer',
+              'patrol_boat')
+
+
+@ndb.tasklet
+def get_user_names_async(keys):
+    """Returns a future of a dict mapping User keys to names, fetched with
+    one get_multi. None keys are skipped"""
+    keys = list(set(key for key in keys if key is not None))
+    users = yield ndb.get_multi_async(keys)
+    raise ndb.Return(dict((user.key, user.name)
+                          for user in users if user is not None))
+
+
+def get_user_names(keys):
+    return get_user_names_async(keys).get_result()
 
 
 class User(ndb.Model):
@@ -18,12 +38,20 @@ class User(ndb.Model):
 
 class Game(ndb.Model):
     """Game object"""
+    # Cached by version instead, see utils.get_cached_game_async
+    _use_memcache = False
+
     player1 = ndb.KeyProperty(required=True, kind='User')
     player2 = ndb.KeyProperty(kind='User')
     player1_ships_remaining = ndb.IntegerProperty(required=True,
                                                   default=DEFAULT_SHIPS)
     player2_ships_remaining = ndb.IntegerProperty(required=True,
                                                   default=DEFAULT_SHIPS)
+    # Both players' boards in the packed format of board.pack_boards, only
+    # read to migrate games stored before the boards were GameBoards
+    boards = ndb.BlobProperty()
+    # Legacy pickled grids, only read to migrate games stored before the
+    # packed board format
     player1_primary_grid = ndb.PickleProperty(repeated=True)
     player2_primary_grid = ndb.PickleProperty(repeated=True)
     player1_tracking_grid = ndb.PickleProperty(repeated=True)
@@ -47,46 +75,206 @@ class Game(ndb.Model):
     current_player = ndb.KeyProperty(kind='User')
     game_over = ndb.BooleanProperty(required=True, default=False)
     cancelled = ndb.BooleanProperty(required=True, default=False)
+    # The players while the game is in progress, empty once it is over or
+    # cancelled. Set on every put, so that the games of a user are listed
+    # with a single query
+    active_players = ndb.KeyProperty(kind='User', repeated=True)
+    # Moves in the packed move log format of board.pack_move
+    moves = ndb.BlobProperty()
+    # Legacy pickled GameStepForms, only read to migrate games stored before
+    # the move log
     history = ndb.PickleProperty(repeated=True)
     last_move = ndb.DateTimeProperty(auto_now_add=True)
+    # Number of moves made, plus one once cancelled. It only ever grows, so
+    # clients polling get_game_updates can tell what changed since they
+    # last looked
+    version = ndb.ComputedProperty(
+        lambda self: move_count(self.get_moves()) + int(bool(self.cancelled)))
+
+    # Decoded boards, keyed by player '1' and '2', and the packed boards
+    # they were loaded from
+    _boards = None
+    _packed_boards = None
+    # Token of the lock on the cached version taken to write the Game, see
+    # utils.lock_game_version_async
+    _version_lock = None
 
     @classmethod
-    def new_game(cls, user1, user2,
-                 player1_primary_grid, player2_primary_grid,
-                 player1_tracking_grid, player2_tracking_grid):
-        """Creates and returns a new game"""
-        # Ship location is entered arbitrarily in API interface.
-        # This API expect the validation of ship location in frontend.
-        # So that ships are not overlapped.
+    def new_game(cls, user1, user2, player1_board, player2_board):
+        """Creates and returns a new game, not saved yet"""
         game = Game(player1=user1,
                     player2=user2,
                     player1_ships_remaining=DEFAULT_SHIPS,
                     player2_ships_remaining=DEFAULT_SHIPS,
-                    player1_primary_grid=player1_primary_grid,
-                    player2_primary_grid=player2_primary_grid,
-                    player1_tracking_grid=player1_tracking_grid,
-                    player2_tracking_grid=player2_tracking_grid,
                     current_player=user1,
                     game_over=False,
                     cancelled=False,
-                    history=[])
-        game.put()
+                    moves=new_move_log())
+        game._boards = {'1': player1_board, '2': player2_board}
+        game._packed_boards = {}
         return game
 
-    def to_form(self, message):
-        """Returns a GameForm representation of the Game"""
-        form = GameForm()
-        form.urlsafe_key = self.key.urlsafe()
-        form.player1_name = self.player1.get().name
-        if(self.player2):
-            form.player2_name = self.player2.get().name
-        else:
-            form.player2_name = 'Computer'
+    def set_boards(self, game_boards):
+        """Decodes the GameBoards of the Game, read with the keys of
+        GameBoard.keys_of. Games stored before GameBoards have none, their
+        boards are read from the Game"""
+        if None in game_boards:
+            return
+        self._packed_boards = dict((game_board.key.id(), game_board.board)
+                                   for game_board in game_boards)
+        self._boards = dict((player, unpack_boards(data)[0])
+                            for player, data in
+                            self._packed_boards.iteritems())
+
+    def has_boards(self):
+        """Returns whether get_board can be called, the GameBoards having
+        been loaded or the boards being still stored in the Game"""
+        return self._boards is not None or bool(self.boards) or \
+            bool(self.player1_primary_grid)
+
+    def get_board(self, player):
+        """Returns the Board of player '1' or '2'. The GameBoards must have
+        been loaded, unless the boards are still stored in the Game"""
+        if self._boards is None:
+            if self.boards:
+                board1, board2 = unpack_boards(self.boards)
+            elif self.player1_primary_grid:
+                board1 = Board.from_grids(self.player1_primary_grid,
+                                          self.player2_tracking_grid)
+                board2 = Board.from_grids(self.player2_primary_grid,
+                                          self.player1_tracking_grid)
+            else:
+                raise ValueError('The boards of the game are not loaded')
+            self._boards = {'1': board1, '2': board2}
+            self._packed_boards = {}
+        return self._boards[player]
+
+    def game_boards(self):
+        """Returns the GameBoards of players 1 and 2 as the boards are now,
+        or None if they are not loaded. The Game needs a complete key"""
+        if self._boards is None:
+            return None
+        return [GameBoard(key=key, board=pack_boards([self._boards[player]]))
+                for player, key in zip(PLAYERS, GameBoard.keys_of(self.key))]
+
+    def entities(self):
+        """Returns the Game and the GameBoards changed since they were
+        loaded, to be put together"""
+        packed_boards = self._packed_boards or {}
+        return [self] + [game_board
+                         for game_board in self.game_boards() or []
+                         if game_board.board !=
+                         packed_boards.get(game_board.key.id())]
+
+    def needs_migration(self):
+        """Returns True if the boards are still stored in the Game, the
+        moves as pickled GameStepForms, or the game is in progress without
+        its active players"""
+        return bool(self.boards) or bool(self.player1_primary_grid) or \
+            self.moves is None or \
+            not (self.game_over or self.cancelled or self.active_players)
+
+    def get_moves(self):
+        """Returns the packed move log, converted from the legacy history
+        if the game has none. Turns always alternated, starting with player
+        1, so the player of a legacy step is told by its position"""
+        if self.moves is None:
+            self.moves = new_move_log() + ''.join(
+                pack_move(i % 2 == 0, move_cell(step.move),
+                          step.is_ship_destroyed)
+                for i, step in enumerate(self.history))
+            self.history = []
+        return self.moves
+
+    def add_move(self, is_player1_move, cell, is_sunk):
+        """Appends a move to the move log"""
+        self.moves = self.get_moves() + \
+            pack_move(is_player1_move, cell, is_sunk)
+
+    def _player_names(self, names):
+        """Maps whether a move is player 1's to the name of its player"""
+        return {True: names[self.player1],
+                False: names.get(self.player2, 'Computer')}
+
+    def to_step_forms(self, names):
+        """Returns a GameStepForm for each move, decoded from the move log.
+        names maps User keys to names"""
+        player_names = self._player_names(names)
+        return [GameStepForm(player=player_names[is_player1_move],
+                             move=move_name(cell),
+                             is_ship_destroyed=is_sunk)
+                for is_player1_move, cell, is_sunk
+                in unpack_moves(self.get_moves())]
+
+    def to_update_form(self, version, names):
+        """Returns a GameUpdateForm with the moves made since version, each
+        with the result of its shot as the tracking grid shows it"""
+        form = GameUpdateForm(
+            version=self.version,
+            unchanged=False,
+            current_player=names.get(self.current_player, 'Computer'),
+            player1_ships_remaining=self.player1_ships_remaining,
+            player2_ships_remaining=self.player2_ships_remaining,
+            game_over=self.game_over,
+            cancelled=self.cancelled)
+        player_names = self._player_names(names)
+        for is_player1_move, cell, is_sunk in \
+                unpack_moves(self.get_moves(), version):
+            target = self.get_board('2' if is_player1_move else '1')
+            form.moves.append(GameStepForm(
+                player=player_names[is_player1_move],
+                move=move_name(cell),
+                is_ship_destroyed=is_sunk,
+                result=target.tracking_cell(CELL_BITS[cell])))
+        return form
+
+    def primary_grid(self, player):
+        return self.get_board(player).to_primary_grid()
+
+    def tracking_grid(self, player):
+        if player == '1':
+            return self.get_board('2').to_tracking_grid()
+        return self.get_board('1').to_tracking_grid()
 
-        if(self.current_player):
-            form.current_player = self.current_player.get().name
+    def _pre_put_hook(self):
+        self.get_moves()
+        if self.game_over or self.cancelled:
+            self.active_players = []
         else:
-            form.current_player = 'Computer'
+            self.active_players = [key for key in (self.player1, self.player2)
+                                   if key is not None]
+        if self._boards is not None:
+            # Moved to the GameBoards put along, see entities
+            self.boards = None
+            self.player1_primary_grid = []
+            self.player2_primary_grid = []
+            self.player1_tracking_grid = []
+            self.player2_tracking_grid = []
+
+    def user_keys(self):
+        """Returns the keys of the Users referenced by the Game"""
+        return [self.player1, self.player2, self.current_player]
+
+    @classmethod
+    def to_forms(cls, games, message, names=None):
+        """Returns GameForms for a list of Games, resolving the names of all
+        their Users with a single get_multi unless names is given"""
+        if names is None:
+            names = get_user_names(
+                [key for game in games for key in game.user_keys()])
+        return [game.to_form(message, names) for game in games]
+
+    def to_form(self, message, names=None):
+        """Returns a GameForm representation of the Game. names maps User
+        keys to names, it is looked up when not given"""
+        form = GameForm()
+        form.urlsafe_key = self.key.urlsafe()
+        form.version = self.version
+        if names is None:
+            names = get_user_names(self.user_keys())
+        form.player1_name = names[self.player1]
+        form.player2_name = names.get(self.player2, 'Computer')
+        form.current_player = names.get(self.current_player, 'Computer')
 
         form.player1_ships_remaining = self.player1_ships_remaining
         form.player2_ships_remaining = self.player2_ships_remaining
@@ -97,20 +285,36 @@ class Game(ndb.Model):
         form.message = message
         return form
 
-    def to_game_move_form(self, message, is_player1_move):
-        """Returns a GameForm representation of the Game"""
+    def remaining_counts(self, player):
+        """Returns the cells left of each ship of player, in SHIP_NAMES
+        order"""
+        return [getattr(self, 'player%s_%s_remaining' % (player, name))
+                for name in SHIP_NAMES]
+
+    def to_game_move_form(self, message, is_player1_move, names=None,
+                          compact=False):
+        """Returns a GameForm representation of the Game. compact sends the
+        grids as strings and the ship counters as a list"""
         form = GameForm()
         form.urlsafe_key = self.key.urlsafe()
+        form.version = self.version
         form.message = message
 
-        if(self.current_player):
-            form.current_player = self.current_player.get().name
-        else:
-            form.current_player = 'Computer'
-
-        if is_player1_move:
-            form.primary_grid = self.to_grid_form(self.player1_primary_grid)
-            form.tracking_grid = self.to_grid_form(self.player1_tracking_grid)
+        if names is None:
+            names = get_user_names([self.current_player])
+        form.current_player = names.get(self.current_player, 'Computer')
+
+        if compact:
+            player, opponent = ('1', '2') if is_player1_move else ('2', '1')
+            form.primary_board = self.get_board(player).to_primary_string()
+            form.tracking_board = \
+                self.get_board(opponent).to_tracking_string()
+            form.ships_remaining = getattr(
+                self, 'player%s_ships_remaining' % player)
+            form.remaining = self.remaining_counts(player)
+        elif is_player1_move:
+            form.primary_grid = self.to_grid_form(self.primary_grid('1'))
+            form.tracking_grid = self.to_grid_form(self.tracking_grid('1'))
             form.ships_remaining = self.player1_ships_remaining
             form.aircraft_carrier_remaining = \
                 self.player1_aircraft_carrier_remaining
@@ -119,8 +323,8 @@ class Game(ndb.Model):
             form.destroyer_remaining = self.player1_destroyer_remaining
             form.patrol_boat_remaining = self.player1_patrol_boat_remaining
         else:
-            form.primary_grid = self.to_grid_form(self.player2_primary_grid)
-            form.tracking_grid = self.to_grid_form(self.player2_tracking_grid)
+            form.primary_grid = self.to_grid_form(self.primary_grid('2'))
+            form.tracking_grid = self.to_grid_form(self.tracking_grid('2'))
             form.ships_remaining = self.player2_ships_remaining
             form.aircraft_carrier_remaining = \
                 self.player2_aircraft_carrier_remaining
@@ -130,29 +334,43 @@ class Game(ndb.Model):
             form.patrol_boat_remaining = self.player2_patrol_boat_remaining
         return form
 
-    def to_game_over_form(self, message):
-        """Returns a GameForm representation of the Game"""
+    def to_game_over_form(self, message, names=None, compact=False):
+        """Returns a GameForm representation of the Game. compact sends the
+        grids as strings and the ship counters as lists"""
         form = GameForm()
         form.urlsafe_key = self.key.urlsafe()
-        form.player1_name = self.player1.get().name
-        if(self.player2):
-            form.player2_name = self.player2.get().name
-        else:
-            form.player2_name = 'Computer'
+        form.version = self.version
+        if names is None:
+            names = get_user_names(self.user_keys())
+        form.player1_name = names[self.player1]
+        form.player2_name = names.get(self.player2, 'Computer')
+        form.current_player = names.get(self.current_player, 'Computer')
+        form.player1_ships_remaining = self.player1_ships_remaining
+        form.player2_ships_remaining = self.player2_ships_remaining
+        form.game_over = self.game_over
+        form.cancelled = self.cancelled
+        form.last_move = self.last_move
+        form.message = message
 
-        if(self.current_player):
-            form.current_player = self.current_player.get().name
-        else:
-            form.current_player = 'Computer'
+        if compact:
+            board1 = self.get_board('1')
+            board2 = self.get_board('2')
+            form.player1_primary_board = board1.to_primary_string()
+            form.player2_primary_board = board2.to_primary_string()
+            form.player1_tracking_board = board2.to_tracking_string()
+            form.player2_tracking_board = board1.to_tracking_string()
+            form.player1_remaining = self.remaining_counts('1')
+            form.player2_remaining = self.remaining_counts('2')
+            return form
 
         form.player1_primary_grid = \
-            self.to_grid_form(self.player1_primary_grid)
+            self.to_grid_form(self.primary_grid('1'))
         form.player2_primary_grid = \
-            self.to_grid_form(self.player2_primary_grid)
+            self.to_grid_form(self.primary_grid('2'))
         form.player1_tracking_grid = \
-            self.to_grid_form(self.player1_tracking_grid)
+            self.to_grid_form(self.tracking_grid('1'))
         form.player2_tracking_grid = \
-            self.to_grid_form(self.player2_tracking_grid)
+            self.to_grid_form(self.tracking_grid('2'))
 
         form.player1_aircraft_carrier_remaining = \
             self.player1_aircraft_carrier_remaining
@@ -166,13 +384,6 @@ class Game(ndb.Model):
         form.player2_submarine_remaining = self.player2_submarine_remaining
         form.player2_destroyer_remaining = self.player2_destroyer_remaining
         form.player2_patrol_boat_remaining = self.player2_patrol_boat_remaining
-        form.player1_ships_remaining = self.player1_ships_remaining
-        form.player2_ships_remaining = self.player2_ships_remaining
-
-        form.game_over = self.game_over
-        form.cancelled = self.cancelled
-        form.last_move = self.last_move
-        form.message = message
         return form
 
     def to_grid_form(self, grids):
@@ -189,21 +400,53 @@ class Game(ndb.Model):
                     J=grids[9]
                )
 
-    def end_game(self, winner=False):
-        """Ends the game - winner will be either player 1 or 2,
-        or will be False if AI wins"""
+    def finish(self, winner=False):
+        """Marks the game over - winner will be either player 1 or 2, or
+        will be False if AI wins. Returns the Score of the winner, not saved
+        yet, or None if AI wins"""
         self.game_over = True
-        self.put()
         # Add the game to the score 'board' if a player wins
         if(winner):
             if(winner == self.player1):
                 ships_remaining = self.player1_ships_remaining
             else:
                 ships_remaining = self.player2_ships_remaining
-            score = Score(winner=winner,
-                          date=date.today(),
-                          ships_remaining=ships_remaining)
-            score.put()
+            return Score(winner=winner,
+                         date=date.today(),
+                         ships_remaining=ships_remaining,
+                         ranked=True)
+
+    @ndb.tasklet
+    def end_game_async(self, winner=False, winner_name=None):
+        """Ends the game. The Game, the Score and the winner's Ranking are
+        written in one transaction"""
+        score = self.finish(winner)
+        if score:
+            # Joins the transaction of make_moves if there is one
+            @ndb.transactional_tasklet(
+                xg=True, propagation=ndb.TransactionOptions.ALLOWED)
+            def put_with_score():
+                ranking = yield Ranking.add_scores_async(winner, [score],
+                                                         winner_name)
+                yield ndb.put_multi_async(self.entities() + [score, ranking])
+            yield put_with_score()
+        else:
+            yield ndb.put_multi_async(self.entities())
+
+
+class GameBoard(ndb.Model):
+    """The board of one player of a Game: the fleet and the shots fired at
+    it, packed by board.pack_boards. A child of the Game keyed by the
+    player, so that moves update both in one transaction while the
+    endpoints needing none of the boards only read the Game"""
+    _use_memcache = False
+
+    board = ndb.BlobProperty(required=True)
+
+    @classmethod
+    def keys_of(cls, game_key):
+        """Returns the keys of the GameBoards of players 1 and 2"""
+        return [ndb.Key(cls, player, parent=game_key) for player in PLAYERS]
 
 
 class Score(ndb.Model):
@@ -212,18 +455,77 @@ class Score(ndb.Model):
     winner = ndb.KeyProperty(required=True, kind='User')
     date = ndb.DateProperty(required=True)
     ships_remaining = ndb.IntegerProperty(required=True)
+    # Whether the score has been added to the winner's Ranking
+    ranked = ndb.BooleanProperty(default=False, indexed=False)
 
-    def to_form(self):
-        return ScoreForm(winner=self.winner.get().name,
+    @classmethod
+    def to_forms(cls, scores, names=None):
+        """Returns ScoreForms for a list of Scores, resolving the names of all
+        winners with a single get_multi unless names is given"""
+        if names is None:
+            names = get_user_names([score.winner for score in scores])
+        return [score.to_form(names) for score in scores]
+
+    def to_form(self, names=None):
+        if names is None:
+            name = self.winner.get().name
+        else:
+            name = names[self.winner]
+        return ScoreForm(winner=name,
                          date=str(self.date),
                          ships_remaining=self.ships_remaining)
 
 
+class Ranking(ndb.Model):
+    """Total score of a User over all the games they won, updated whenever
+    a Score is written. Keyed by the id of the User"""
+    user = ndb.KeyProperty(required=True, kind='User')
+    name = ndb.StringProperty(required=True, indexed=False)
+    score = ndb.IntegerProperty(required=True, default=0)
+    games_won = ndb.IntegerProperty(required=True, default=0, indexed=False)
+
+    @classmethod
+    @ndb.tasklet
+    def add_scores_async(cls, user_key, scores, name=None):
+        """Returns a future of the Ranking of the User with the scores added,
+        ready to be put. Must be called inside a transaction. name is the
+        name of the User, looked up if not given"""
+        ranking = yield ndb.Key(cls, user_key.id()).get_async()
+        if ranking is None:
+            if name is None:
+                user = yield user_key.get_async()
+                name = user.name
+            ranking = cls(id=user_key.id(), user=user_key, name=name)
+        ranking.add(scores)
+        raise ndb.Return(ranking)
+
+    @classmethod
+    def add_scores(cls, user_key, scores):
+        return cls.add_scores_async(user_key, scores).get_result()
+
+    def add(self, scores):
+        for score in scores:
+            self.score += score.ships_remaining
+            self.games_won += 1
+
+    def to_form(self):
+        return RankForm(user=self.name, score=self.score)
+
+
+class MoveResultForm(messages.Message):
+    """MoveResultForm for the outcome of one move of a make_moves call"""
+    move = messages.StringField(1, required=True)
+    applied = messages.BooleanField(2, required=True)
+    message = messages.StringField(3, required=True)
+
+
 class GameStepForm(messages.Message):
     """GameStepForm for outbound game history"""
     player = messages.StringField(1, required=True)
     move = messages.StringField(2, required=True)
     is_ship_destroyed = messages.BooleanField(3, required=True)
+    # The ship code hit or 'x', only set by get_game_updates
+    result = messages.StringField(4)
 
 
 class GameStepForms(messages.Message):
@@ -231,6 +533,18 @@ class GameStepForms(messages.Message):
     items = messages.MessageField(GameStepForm, 1, repeated=True)
 
 
+class GameUpdateForm(messages.Message):
+    """GameUpdateForm for the changes to a game since a version"""
+    version = messages.IntegerField(1, required=True)
+    unchanged = messages.BooleanField(2, required=True)
+    moves = messages.MessageField(GameStepForm, 3, repeated=True)
+    current_player = messages.StringField(4)
+    player1_ships_remaining = messages.IntegerField(5)
+    player2_ships_remaining = messages.IntegerField(6)
+    game_over = messages.BooleanField(7)
+    cancelled = messages.BooleanField(8)
+
+
 class GridForm(messages.Message):
     """GameStepForm for outbound game history"""
     A = messages.StringField(1, repeated=True)
@@ -260,6 +574,7 @@ class GameForm(messages.Message):
 
     ships_remaining = messages.IntegerField(10)
     current_player = messages.StringField(11)
+    version = messages.IntegerField(12)
 
     # For to_game_move_form
     primary_grid = messages.MessageField(GridForm, 21)
@@ -292,10 +607,25 @@ class GameForm(messages.Message):
     player1_ships_remaining = messages.IntegerField(46)
     player2_ships_remaining = messages.IntegerField(47)
 
+    # Compact format, sent instead of the grids and ship counters above when
+    # requested. Grids are strings of 100 cells, row by row, with the first
+    # letter of the ship codes, and the counters are the cells left of each
+    # ship in the order ac, bs, sm, dt, pb
+    primary_board = messages.StringField(48)
+    tracking_board = messages.StringField(49)
+    remaining = messages.IntegerField(50, repeated=True)
+    player1_primary_board = messages.StringField(51)
+    player2_primary_board = messages.StringField(52)
+    player1_tracking_board = messages.StringField(53)
+    player2_tracking_board = messages.StringField(54)
+    player1_remaining = messages.IntegerField(55, repeated=True)
+    player2_remaining = messages.IntegerField(56, repeated=True)
+
 
 class GameForms(messages.Message):
     """Return multiple GameForms"""
     items = messages.MessageField(GameForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
 
 
 class GridRowNum(messages.Enum):
@@ -313,57 +643,44 @@ class GridRowNum(messages.Enum):
 
 
 class NewGameForm(messages.Message):
-    """Used to create a new game"""
+    """Used to create a new game. The ships of a player are placed at random
+    when auto place is set, the placement fields are required otherwise"""
     player1_name = messages.StringField(1, required=True)
     player2_name = messages.StringField(2)
-
-    player1_aircraft_carrier_is_horizontal = \
-        messages.BooleanField(3, required=True)
-    player1_aircraft_carrier_start_row = \
-        messages.EnumField('GridRowNum', 4, required=True)
-    player1_aircraft_carrier_start_col = \
-        messages.IntegerField(5, required=True)
-    player1_battleship_is_horizontal = messages.BooleanField(6, required=True)
-    player1_battleship_start_row = \
-        messages.EnumField('GridRowNum', 7, required=True)
-    player1_battleship_start_col = messages.IntegerField(8, required=True)
-    player1_submarine_is_horizontal = messages.BooleanField(9, required=True)
-    player1_submarine_start_row = \
-        messages.EnumField('GridRowNum', 10, required=True)
-    player1_submarine_start_col = messages.IntegerField(11, required=True)
-    player1_destroyer_is_horizontal = messages.BooleanField(12, required=True)
-    player1_destroyer_start_row = \
-        messages.EnumField('GridRowNum', 13, required=True)
-    player1_destroyer_start_col = messages.IntegerField(14, required=True)
-    player1_patrol_boat_is_horizontal = \
-        messages.BooleanField(15, required=True)
-    player1_patrol_boat_start_row = \
-        messages.EnumField('GridRowNum', 16, required=True)
-    player1_patrol_boat_start_col = messages.IntegerField(17, required=True)
-
-    player2_aircraft_carrier_is_horizontal = \
-        messages.BooleanField(18, required=True)
-    player2_aircraft_carrier_start_row = \
-        messages.EnumField('GridRowNum', 19, required=True)
-    player2_aircraft_carrier_start_col = \
-        messages.IntegerField(20, required=True)
-    player2_battleship_is_horizontal = messages.BooleanField(21, required=True)
-    player2_battleship_start_row = \
-        messages.EnumField('GridRowNum', 22, required=True)
-    player2_battleship_start_col = messages.IntegerField(23, required=True)
-    player2_submarine_is_horizontal = messages.BooleanField(24, required=True)
-    player2_submarine_start_row = \
-        messages.EnumField('GridRowNum', 25, required=True)
-    player2_submarine_start_col = messages.IntegerField(26, required=True)
-    player2_destroyer_is_horizontal = messages.BooleanField(27, required=True)
-    player2_destroyer_start_row = \
-        messages.EnumField('GridRowNum', 28, required=True)
-    player2_destroyer_start_col = messages.IntegerField(29, required=True)
-    player2_patrol_boat_is_horizontal = \
-        messages.BooleanField(30, required=True)
-    player2_patrol_boat_start_row = \
-        messages.EnumField('GridRowNum', 31, required=True)
-    player2_patrol_boat_start_col = messages.IntegerField(32, required=True)
+    player1_auto_place = messages.BooleanField(33, default=False)
+    player2_auto_place = messages.BooleanField(34, default=False)
+
+    player1_aircraft_carrier_is_horizontal = messages.BooleanField(3)
+    player1_aircraft_carrier_start_row = messages.EnumField('GridRowNum', 4)
+    player1_aircraft_carrier_start_col = messages.IntegerField(5)
+    player1_battleship_is_horizontal = messages.BooleanField(6)
+    player1_battleship_start_row = messages.EnumField('GridRowNum', 7)
+    player1_battleship_start_col = messages.IntegerField(8)
+    player1_submarine_is_horizontal = messages.BooleanField(9)
+    player1_submarine_start_row = messages.EnumField('GridRowNum', 10)
+    player1_submarine_start_col = messages.IntegerField(11)
+    player1_destroyer_is_horizontal = messages.BooleanField(12)
+    player1_destroyer_start_row = messages.EnumField('GridRowNum', 13)
+    player1_destroyer_start_col = messages.IntegerField(14)
+    player1_patrol_boat_is_horizontal = messages.BooleanField(15)
+    player1_patrol_boat_start_row = messages.EnumField('GridRowNum', 16)
+    player1_patrol_boat_start_col = messages.IntegerField(17)
+
+    player2_aircraft_carrier_is_horizontal = messages.BooleanField(18)
+    player2_aircraft_carrier_start_row = messages.EnumField('GridRowNum', 19)
+    player2_aircraft_carrier_start_col = messages.IntegerField(20)
+    player2_battleship_is_horizontal = messages.BooleanField(21)
+    player2_battleship_start_row = messages.EnumField('GridRowNum', 22)
+    player2_battleship_start_col = messages.IntegerField(23)
+    player2_submarine_is_horizontal = messages.BooleanField(24)
+    player2_submarine_start_row = messages.EnumField('GridRowNum', 25)
+    player2_submarine_start_col = messages.IntegerField(26)
+    player2_destroyer_is_horizontal = messages.BooleanField(27)
+    player2_destroyer_start_row = messages.EnumField('GridRowNum', 28)
+    player2_destroyer_start_col = messages.IntegerField(29)
+    player2_patrol_boat_is_horizontal = messages.BooleanField(30)
+    player2_patrol_boat_start_row = messages.EnumField('GridRowNum', 31)
+    player2_patrol_boat_start_col = messages.IntegerField(32)
 
 
 class MakeMoveForm(messages.Message):
@@ -373,6 +690,17 @@ class MakeMoveForm(messages.Message):
     move_col = messages.IntegerField(3, required=True)
 
 
+class MakeMovesForm(messages.Message):
+    """Used to make several moves in an existing game at once"""
+    moves = messages.MessageField(MakeMoveForm, 1, repeated=True)
+
+
+class MoveResultForms(messages.Message):
+    """Return the results of a make_moves call and the final game state"""
+    items = messages.MessageField(MoveResultForm, 1, repeated=True)
+    game = messages.MessageField(GameForm, 2)
+
+
 class ScoreForm(messages.Message):
     """ScoreForm for outbound Score information"""
     winner = messages.StringField(1, required=True)
@@ -383,6 +711,7 @@ class ScoreForm(messages.Message):
 class ScoreForms(messages.Message):
     """Return multiple ScoreForms"""
     items = messages.MessageField(ScoreForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
 
 
 class RankForm(messages.Message):
@@ -394,6 +723,7 @@ class RankForm(messages.Message):
 class RankForms(messages.Message):
     """Return multiple RankForms"""
     items = messages.MessageField(RankForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
 
 
 class StringMessage(messages.Message):
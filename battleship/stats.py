@@ -0,0 +1,293 @@
+"""stats.py - Instrumentation of the endpoints methods. For each request the
+middleware wrapping the API app and the instrumented decorator of the
+methods record:
+
+    wall_ms            time from the request to the response body
+    method_ms          time spent in the endpoints method
+    serialization_ms   the rest, decoding the request and encoding the
+                       response
+    datastore_rpcs     datastore calls, counted by an apiproxy hook
+    rpcs               calls to any service
+    memcache_hits      keys found by memcache gets
+    memcache_misses    keys not found by memcache gets
+    response_bytes     size of the response body
+
+Each instance adds them up in histograms by method and every FLUSH_INTERVAL
+seconds merges them into the histograms of the current window in memcache,
+so that the windows hold the requests of all instances. get_summary reads
+back the last windows. A share of the requests, set by the
+BATTLESHIP_TRACE_RATE environment variable, is also traced: the services
+called are kept with their time, logged and kept in a per-instance log."""
+
+import bisect
+import collections
+import functools
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map, memcache
+
+STATS_MEMCACHE_PREFIX = 'stats:'
+WINDOW_SECONDS = 60
+WINDOWS = 15
+FLUSH_INTERVAL = 10
+STATS_CAS_RETRIES = 3
+TRACE_RATE_ENV = 'BATTLESHIP_TRACE_RATE'
+TRACE_LOG_SIZE = 100
+HOOK_KEY = 'battleship-stats'
+
+# Upper bounds of the buckets of the histograms, a last bucket holds the
+# values above them
+TIME_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+COUNT_BUCKETS = (0, 1, 2, 3, 4, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+METRICS = (
+    ('wall_ms', TIME_BUCKETS),
+    ('method_ms', TIME_BUCKETS),
+    ('serialization_ms', TIME_BUCKETS),
+    ('datastore_rpcs', COUNT_BUCKETS),
+    ('rpcs', COUNT_BUCKETS),
+    ('memcache_hits', COUNT_BUCKETS),
+    ('memcache_misses', COUNT_BUCKETS),
+    ('response_bytes', SIZE_BUCKETS),
+)
+PERCENTILES = (50, 95, 99)
+
+_local = threading.local()
+_lock = threading.Lock()
+# Histograms not flushed to memcache yet, by method
+_pending = {}
+_last_flush = [time.time()]
+_traces = collections.deque(maxlen=TRACE_LOG_SIZE)
+
+
+class Trace(object):
+    """Measurements of the request being handled by the current thread"""
+
+    def __init__(self, sampled=False):
+        self.start = time.time()
+        self.method = None
+        self.method_time = 0
+        self.rpcs = collections.Counter()
+        self.memcache_hits = 0
+        self.memcache_misses = 0
+        # Offset in ms and name of each call to a service, if sampled
+        self.calls = [] if sampled else None
+
+    def values(self, wall_time, response_bytes):
+        """Returns the value of each of METRICS"""
+        return {
+            'wall_ms': wall_time * 1000,
+            'method_ms': self.method_time * 1000,
+            'serialization_ms': (wall_time - self.method_time) * 1000,
+            'datastore_rpcs': self.rpcs['datastore_v3'],
+            'rpcs': sum(self.rpcs.itervalues()),
+            'memcache_hits': self.memcache_hits,
+            'memcache_misses': self.memcache_misses,
+            'response_bytes': response_bytes,
+        }
+
+
+def _count_rpc(service, call, request, response):
+    """apiproxy post call hook counting the calls of the current request"""
+    trace = getattr(_local, 'trace', None)
+    if trace is None:
+        return
+    trace.rpcs[service] += 1
+    if service == 'memcache' and call == 'Get':
+        hits = response.item_size()
+        trace.memcache_hits += hits
+        trace.memcache_misses += request.key_size() - hits
+    if trace.calls is not None:
+        trace.calls.append((round((time.time() - trace.start) * 1000, 3),
+                            '%s.%s' % (service, call)))
+
+
+def _trace_rate():
+    try:
+        return float(os.environ.get(TRACE_RATE_ENV, 0))
+    except ValueError:
+        return 0
+
+
+def instrumented(method):
+    """Decorates an endpoints method, under endpoints.method, to record its
+    name and run time in the trace of the request"""
+    @functools.wraps(method)
+    def wrapper(self, request):
+        trace = getattr(_local, 'trace', None)
+        if trace is None:
+            return method(self, request)
+        trace.method = method.__name__
+        start = time.time()
+        try:
+            return method(self, request)
+        finally:
+            trace.method_time = time.time() - start
+    return wrapper
+
+
+class StatsMiddleware(object):
+    """WSGI middleware measuring the requests to the endpoints methods"""
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        # The testbed of the tools replaces the apiproxy, appending to the
+        # current one each time covers it. Appending a hook twice is a no-op
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(HOOK_KEY,
+                                                             _count_rpc)
+        trace = Trace(sampled=random.random() < _trace_rate())
+        statuses = []
+
+        def record_status(status, headers, exc_info=None):
+            statuses.append(status)
+            return start_response(status, headers, exc_info)
+
+        _local.trace = trace
+        try:
+            body = list(self.app(environ, record_status))
+        finally:
+            _local.trace = None
+        if trace.method is not None:
+            wall_time = time.time() - trace.start
+            error = not statuses or not statuses[-1].startswith('2')
+            record(trace.method, trace.values(
+                wall_time, sum(len(chunk) for chunk in body)), error)
+            if trace.calls is not None:
+                _add_trace(trace, wall_time, statuses)
+        return body
+
+
+def _new_histograms():
+    histograms = {'requests': 0, 'errors': 0}
+    for metric, buckets in METRICS:
+        # Bucket counts followed by the sum of the values
+        histograms[metric] = [0] * (len(buckets) + 2)
+    return histograms
+
+
+def _merge(into, histograms):
+    for name, value in histograms.iteritems():
+        if name not in into:
+            into[name] = value
+        elif isinstance(value, list):
+            into[name] = [a + b for a, b in zip(into[name], value)]
+        else:
+            into[name] += value
+
+
+def record(method, values, error=False):
+    """Adds the metric values of a request to the histograms of method"""
+    with _lock:
+        histograms = _pending.get(method)
+        if histograms is None:
+            histograms = _pending[method] = _new_histograms()
+        histograms['requests'] += 1
+        histograms['errors'] += int(error)
+        for metric, buckets in METRICS:
+            value = values[metric]
+            counts = histograms[metric]
+            counts[bisect.bisect_left(buckets, value)] += 1
+            counts[-1] += value
+        due = time.time() - _last_flush[0] >= FLUSH_INTERVAL
+    if due:
+        flush()
+
+
+def _window_key(window):
+    return '%s%d' % (STATS_MEMCACHE_PREFIX, window)
+
+
+def flush():
+    """Merges the histograms of this instance into the current window in
+    memcache, with compare and set as every instance writes to it. They are
+    kept for the next flush should that fail"""
+    with _lock:
+        pending = dict(_pending)
+        _pending.clear()
+        _last_flush[0] = time.time()
+    if not pending:
+        return
+    key = _window_key(int(time.time()) // WINDOW_SECONDS)
+    client = memcache.Client()
+    for _ in range(STATS_CAS_RETRIES):
+        window = client.gets(key)
+        if window is None:
+            if client.add(key, pending,
+                          time=WINDOW_SECONDS * (WINDOWS + 1)):
+                return
+            continue
+        for method, histograms in pending.iteritems():
+            _merge(window.setdefault(method, {}), histograms)
+        if client.cas(key, window, time=WINDOW_SECONDS * (WINDOWS + 1)):
+            return
+    logging.warning('Could not flush the stats of %d methods', len(pending))
+    with _lock:
+        for method, histograms in pending.iteritems():
+            _merge(_pending.setdefault(method, {}), histograms)
+
+
+def _add_trace(trace, wall_time, statuses):
+    entry = {
+        'method': trace.method,
+        'start': trace.start,
+        'status': statuses[-1] if statuses else None,
+        'wall_ms': round(wall_time * 1000, 3),
+        'method_ms': round(trace.method_time * 1000, 3),
+        'calls': trace.calls,
+    }
+    logging.info('trace %s', json.dumps(entry, sort_keys=True))
+    _traces.append(entry)
+
+
+def get_traces():
+    """Returns the sampled traces of this instance, latest first"""
+    return list(reversed(_traces))
+
+
+def _percentile(counts, buckets, p):
+    """Returns the upper bound of the bucket holding the percentile p, None
+    when it is the last, unbounded one"""
+    rank = p / 100.0 * sum(counts)
+    seen = 0
+    for i, count in enumerate(counts):
+        seen += count
+        if seen >= rank:
+            return buckets[i] if i < len(buckets) else None
+    return None
+
+
+def get_summary(minutes=WINDOWS):
+    """Returns the requests, errors and histograms of each method over the
+    last minutes, flushing those of this instance first"""
+    flush()
+    now = int(time.time()) // WINDOW_SECONDS
+    keys = [_window_key(window)
+            for window in range(now - min(minutes, WINDOWS) + 1, now + 1)]
+    merged = {}
+    for window in memcache.get_multi(keys).itervalues():
+        for method, histograms in window.iteritems():
+            _merge(merged.setdefault(method, {}), histograms)
+
+    summary = {}
+    for method, histograms in merged.iteritems():
+        requests = histograms['requests']
+        method_summary = summary[method] = {
+            'requests': requests,
+            'errors': histograms['errors'],
+        }
+        for metric, buckets in METRICS:
+            counts, total = histograms[metric][:-1], histograms[metric][-1]
+            metric_summary = method_summary[metric] = {
+                'mean': round(float(total) / requests, 3) if requests else 0,
+                'histogram': zip(list(buckets) + [None], counts),
+            }
+            for p in PERCENTILES:
+                metric_summary['p%d' % p] = _percentile(counts, buckets, p)
+    return summary
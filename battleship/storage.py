@@ -0,0 +1,673 @@
+"""storage.py - Repositories the API reads and writes Users, Games, Scores
+and Rankings through. NdbRepository is the datastore, used in production.
+MemoryRepository and SqliteRepository run the same endpoint logic off App
+Engine, to load test it or to tell the cost of storage apart from the cost
+of the game logic. Every backend deals in the ndb models of models.py, the
+non ndb ones store them encoded as they would be in the datastore.
+
+The backend is chosen by the BATTLESHIP_STORAGE environment variable:
+'ndb' (the default), 'memory' or 'sqlite:<path of the database file>'."""
+
+import os
+import threading
+from contextlib import contextmanager
+
+from google.appengine.datastore import entity_pb
+from google.appengine.ext import ndb
+import endpoints
+
+from models import User, Game, GameBoard, Score, Ranking,\
+    get_user_names_async
+from utils import get_user_key, cache_user_key, fetch_page, get_page_size,\
+    key_from_urlsafe, get_cached_game_async, add_game_async,\
+    get_cached_game_boards_async, cache_game_boards_async
+
+try:
+    import sqlite3
+except ImportError:
+    # Not available on App Engine, where the ndb backend is used
+    sqlite3 = None
+
+STORAGE_ENV = 'BATTLESHIP_STORAGE'
+
+# ScoreForms need nothing but these, so Scores are read from the index
+SCORE_FORM_PROJECTION = [Score.winner, Score.date, Score.ships_remaining]
+# Nor do the GameForms of Game.to_form
+GAME_FORM_PROJECTION = [Game.player1, Game.player2, Game.current_player,
+                        Game.player1_ships_remaining,
+                        Game.player2_ships_remaining, Game.game_over,
+                        Game.cancelled, Game.last_move, Game.version]
+
+_adapter = ndb.ModelAdapter()
+
+
+def _completed(result):
+    """Returns an ndb Future already holding result"""
+    future = ndb.Future()
+    future.set_result(result)
+    return future
+
+
+def _encode(entity):
+    return entity._to_pb().Encode()
+
+
+def _decode(data):
+    return _adapter.pb_to_entity(entity_pb.EntityProto(str(data)))
+
+
+def _id(key):
+    return key.id() if key is not None else None
+
+
+def _row_id(key):
+    """Returns the id of the row of an entity, GameBoards being keyed by the
+    id of their Game and their player"""
+    if key.parent() is None:
+        return key.id()
+    return '%s/%s' % (key.parent().id(), key.id())
+
+
+def _index_values(entity):
+    """Returns the values the non ndb backends filter and order entities on,
+    so that they only decode the entities they return"""
+    if isinstance(entity, User):
+        return {'name': entity.name}
+    if isinstance(entity, GameBoard):
+        return {}
+    if isinstance(entity, Game):
+        return {'player1': _id(entity.player1),
+                'player2': _id(entity.player2),
+                'active_players': map(_id, entity.active_players),
+                'active': not (entity.game_over or entity.cancelled),
+                'last_move': entity.last_move}
+    if isinstance(entity, Score):
+        return {'winner': _id(entity.winner),
+                'ships_remaining': entity.ships_remaining}
+    if isinstance(entity, Ranking):
+        return {'score': entity.score}
+    raise ValueError('Cannot store %s entities' % entity._get_kind())
+
+
+def _parse_cursor(cursor):
+    """Returns the offset a cursor of the non ndb backends stands for"""
+    if not cursor:
+        return 0
+    try:
+        offset = int(cursor)
+    except ValueError:
+        offset = -1
+    if offset < 0:
+        raise endpoints.BadRequestException('Invalid cursor')
+    return offset
+
+
+def _next_cursor(offset, page_size, more):
+    return str(offset + page_size) if more else None
+
+
+class Repository(object):
+    """Storage of the entities of the game. The _async methods return ndb
+    Futures whatever the backend, so that tasklets can yield them. The
+    list methods return a page of entities and the cursor of the next page,
+    or None if it is the last one"""
+
+    def get_multi_async(self, keys):
+        """Returns a list of futures of the entities, None where missing"""
+        raise NotImplementedError
+
+    def put_multi_async(self, entities):
+        """Returns a list of futures of the keys of the entities put"""
+        raise NotImplementedError
+
+    def transaction_async(self, callback):
+        """Runs callback, which returns a future, in a transaction and
+        returns a future of its result. Joins the current transaction if
+        there is one"""
+        raise NotImplementedError
+
+    def in_transaction(self):
+        """Returns whether a transaction of this repository is running"""
+        raise NotImplementedError
+
+    def close(self):
+        """Releases what the calling thread holds of the backend. Threads
+        using the repository call it before they end"""
+
+    def get_user_key(self, name):
+        """Returns the key of the User with the given name, or None"""
+        raise NotImplementedError
+
+    def add_user(self, user):
+        """Puts a new User and returns its key"""
+        raise NotImplementedError
+
+    def allocate_key(self, model):
+        """Returns a new complete key of model, for the children of an
+        entity to be put along with it"""
+        raise NotImplementedError
+
+    def scores_page(self, page_size, cursor, winner=None, best_first=False):
+        """Lists the Scores of winner, or all the Scores. best_first orders
+        them by ships remaining, they are in key order otherwise"""
+        raise NotImplementedError
+
+    def active_games_page(self, user_key, page_size, cursor):
+        """Lists the Games in progress of the User in key order"""
+        raise NotImplementedError
+
+    def rankings_page(self, page_size, cursor):
+        """Lists the Rankings from the highest score down"""
+        raise NotImplementedError
+
+    def get_async(self, key):
+        return self.get_multi_async([key])[0]
+
+    def put_async(self, entity):
+        return self.put_multi_async([entity])[0]
+
+    @ndb.tasklet
+    def get_game_async(self, urlsafe, boards=False):
+        """Returns a future of the Game of a urlsafe key, or None. With
+        boards its GameBoards are read along, in the same get. Outside of
+        transactions Games are read through the cache of utils, which the
+        writers of Games keep up to date with cache_game_async"""
+        key = key_from_urlsafe(urlsafe)
+        in_transaction = self.in_transaction()
+        if not in_transaction:
+            game = yield get_cached_game_async(key, boards)
+            if game is not None:
+                raise ndb.Return(game)
+        keys = [key] + (GameBoard.keys_of(key) if boards else [])
+        entities = yield self.get_multi_async(keys)
+        game = entities[0]
+        if game is None:
+            raise ndb.Return(None)
+        if not isinstance(game, Game):
+            raise ValueError('Incorrect Kind')
+        if boards:
+            game.set_boards(entities[1:])
+        if not in_transaction:
+            yield add_game_async(game)
+        raise ndb.Return(game)
+
+    @ndb.tasklet
+    def load_boards_async(self, game):
+        """Loads the GameBoards of a Game read without them, from the cache
+        of utils or else the datastore. They are read as they are now, so
+        the Game must be one that no longer changes, such as a game over"""
+        if game.has_boards():
+            return
+        game_boards = yield get_cached_game_boards_async(game.key,
+                                                         game.version)
+        if game_boards is None:
+            game_boards = yield self.get_multi_async(
+                GameBoard.keys_of(game.key))
+            game.set_boards(game_boards)
+            yield cache_game_boards_async(game)
+        else:
+            game.set_boards(game_boards)
+
+    @ndb.tasklet
+    def put_game_async(self, game):
+        """Puts the Game with its changed GameBoards, see Game.entities.
+        Returns a future of the key of the Game"""
+        yield self.put_multi_async(game.entities())
+        raise ndb.Return(game.key)
+
+    @ndb.tasklet
+    def get_user_names_async(self, keys):
+        """Returns a future of a dict mapping User keys to names. None keys
+        are skipped"""
+        keys = list(set(key for key in keys if key is not None))
+        users = yield self.get_multi_async(keys)
+        raise ndb.Return(dict((user.key, user.name)
+                              for user in users if user is not None))
+
+    def get_user_names(self, keys):
+        return self.get_user_names_async(keys).get_result()
+
+    @ndb.tasklet
+    def end_game_async(self, game, winner, winner_name):
+        """Ends the game, writing the Game, the Score and the winner's
+        Ranking in one transaction. See Game.end_game_async"""
+        score = game.finish(winner)
+        if score is None:
+            yield self.put_game_async(game)
+            return
+
+        @ndb.tasklet
+        def put_with_score():
+            ranking = yield self.get_async(ndb.Key(Ranking, winner.id()))
+            if ranking is None:
+                ranking = Ranking(id=winner.id(), user=winner,
+                                  name=winner_name)
+            ranking.add([score])
+            yield self.put_multi_async(game.entities() + [score, ranking])
+        yield self.transaction_async(put_with_score)
+
+
+class NdbRepository(Repository):
+    """The datastore, with User keys cached as in utils.get_user_key"""
+
+    def get_multi_async(self, keys):
+        return ndb.get_multi_async(keys)
+
+    def put_multi_async(self, entities):
+        return ndb.put_multi_async(entities)
+
+    def transaction_async(self, callback):
+        return ndb.transaction_async(
+            callback, xg=True, propagation=ndb.TransactionOptions.ALLOWED)
+
+    def in_transaction(self):
+        return ndb.in_transaction()
+
+    def get_user_names_async(self, keys):
+        # Names never change, there is no need to read them transactionally
+        return ndb.non_transactional(get_user_names_async)(keys)
+
+    def end_game_async(self, game, winner, winner_name):
+        return game.end_game_async(winner, winner_name)
+
+    def get_user_key(self, name):
+        return get_user_key(name)
+
+    def add_user(self, user):
+        user.put()
+        cache_user_key(user.name, user.key)
+        return user.key
+
+    def allocate_key(self, model):
+        return ndb.Key(model, model.allocate_ids(1)[0])
+
+    def scores_page(self, page_size, cursor, winner=None, best_first=False):
+        if winner is not None:
+            return fetch_page(Score.query(Score.winner == winner),
+                              page_size, cursor)
+        scores = Score.query()
+        if best_first:
+            scores = scores.order(-Score.ships_remaining)
+        return fetch_page(scores, page_size, cursor,
+                          projection=SCORE_FORM_PROJECTION)
+
+    def active_games_page(self, user_key, page_size, cursor):
+        games = Game.query(Game.active_players == user_key).order(Game.key)
+        return fetch_page(games, page_size, cursor,
+                          projection=GAME_FORM_PROJECTION)
+
+    def rankings_page(self, page_size, cursor):
+        return fetch_page(Ranking.query().order(-Ranking.score),
+                          page_size, cursor)
+
+
+class _LocalRepository(Repository):
+    """Base of the backends storing entities themselves. Ids are allocated
+    by the backend, and the hooks ndb runs before a put are run here"""
+
+    def _allocate_id(self):
+        raise NotImplementedError
+
+    def _prepare(self, entity):
+        """Returns the key, index values and encoded form of the entity"""
+        entity._prepare_for_put()
+        entity._pre_put_hook()
+        if entity.key is None or entity.key.id() is None:
+            entity.key = ndb.Key(entity._get_kind(), self._allocate_id())
+        return entity.key, _index_values(entity), _encode(entity)
+
+    def add_user(self, user):
+        return self.put_async(user).get_result()
+
+    def allocate_key(self, model):
+        return ndb.Key(model, self._allocate_id())
+
+
+class MemoryRepository(_LocalRepository):
+    """Keeps the entities in process, for benchmarks. A transaction holds
+    the lock of the repository and buffers its writes until it commits"""
+
+    def __init__(self):
+        self._rows = {}
+        self._user_ids = {}
+        self._last_id = 0
+        self._lock = threading.RLock()
+        self._local = threading.local()
+
+    def _table(self, kind):
+        return self._rows.setdefault(kind, {})
+
+    def _pending(self):
+        return getattr(self._local, 'pending', None)
+
+    def _allocate_id(self):
+        with self._lock:
+            self._last_id += 1
+            return self._last_id
+
+    def _write(self, rows):
+        for (kind, id), row in rows.iteritems():
+            self._table(kind)[id] = row
+            if kind == 'User':
+                self._user_ids[row[0]['name']] = id
+
+    def get_multi_async(self, keys):
+        with self._lock:
+            pending = self._pending() or {}
+            futures = []
+            for key in keys:
+                row = pending.get((key.kind(), _row_id(key))) or \
+                    self._table(key.kind()).get(_row_id(key))
+                futures.append(_completed(_decode(row[1]) if row else None))
+            return futures
+
+    def put_multi_async(self, entities):
+        with self._lock:
+            rows = {}
+            for entity in entities:
+                key, values, data = self._prepare(entity)
+                rows[(key.kind(), _row_id(key))] = (values, data)
+            pending = self._pending()
+            if pending is None:
+                self._write(rows)
+            else:
+                pending.update(rows)
+            return [_completed(entity.key) for entity in entities]
+
+    def transaction_async(self, callback):
+        with self._lock:
+            if self._pending() is not None:
+                return callback()
+            self._local.pending = {}
+            try:
+                result = callback().get_result()
+                self._write(self._local.pending)
+            finally:
+                self._local.pending = None
+        return _completed(result)
+
+    def in_transaction(self):
+        return self._pending() is not None
+
+    def get_user_key(self, name):
+        with self._lock:
+            id = self._user_ids.get(name)
+        return ndb.Key(User, id) if id is not None else None
+
+    def _page(self, kind, where, order, page_size, cursor):
+        """Returns a page of the entities of kind whose index values pass
+        where, sorted by order, a function of the id and index values"""
+        page_size = get_page_size(page_size)
+        offset = _parse_cursor(cursor)
+        with self._lock:
+            rows = [(id, values, data)
+                    for id, (values, data) in self._table(kind).iteritems()
+                    if where(values)]
+        rows.sort(key=lambda row: order(row[0], row[1]))
+        page = rows[offset:offset + page_size]
+        return [_decode(data) for _, _, data in page], \
+            _next_cursor(offset, page_size, len(rows) > offset + page_size)
+
+    def scores_page(self, page_size, cursor, winner=None, best_first=False):
+        if winner is not None:
+            where = lambda values: values['winner'] == winner.id()
+        else:
+            where = lambda values: True
+        if best_first:
+            order = lambda id, values: (-values['ships_remaining'], id)
+        else:
+            order = lambda id, values: id
+        return self._page('Score', where, order, page_size, cursor)
+
+    def active_games_page(self, user_key, page_size, cursor):
+        def where(values):
+            return user_key.id() in values['active_players']
+        return self._page('Game', where, lambda id, values: id,
+                          page_size, cursor)
+
+    def rankings_page(self, page_size, cursor):
+        return self._page('Ranking', lambda values: True,
+                          lambda id, values: (-values['score'], id),
+                          page_size, cursor)
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS user (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    entity BLOB NOT NULL);
+CREATE UNIQUE INDEX IF NOT EXISTS user_name ON user (name);
+
+CREATE TABLE IF NOT EXISTS game (
+    id INTEGER PRIMARY KEY,
+    player1 INTEGER NOT NULL,
+    player2 INTEGER,
+    active INTEGER NOT NULL,
+    last_move TIMESTAMP,
+    entity BLOB NOT NULL);
+CREATE INDEX IF NOT EXISTS game_last_move ON game (last_move, active);
+
+-- The active_players of each Game, as the datastore indexes them
+CREATE TABLE IF NOT EXISTS game_player (
+    player INTEGER NOT NULL,
+    game INTEGER NOT NULL,
+    PRIMARY KEY (player, game));
+CREATE INDEX IF NOT EXISTS game_player_game ON game_player (game);
+
+CREATE TABLE IF NOT EXISTS game_board (
+    id TEXT PRIMARY KEY,
+    entity BLOB NOT NULL);
+
+CREATE TABLE IF NOT EXISTS score (
+    id INTEGER PRIMARY KEY,
+    winner INTEGER NOT NULL,
+    ships_remaining INTEGER NOT NULL,
+    entity BLOB NOT NULL);
+CREATE INDEX IF NOT EXISTS score_winner ON score (winner);
+CREATE INDEX IF NOT EXISTS score_ships_remaining
+    ON score (ships_remaining DESC, id);
+
+CREATE TABLE IF NOT EXISTS ranking (
+    id INTEGER PRIMARY KEY,
+    score INTEGER NOT NULL,
+    entity BLOB NOT NULL);
+CREATE INDEX IF NOT EXISTS ranking_score ON ranking (score DESC, id);
+
+CREATE TABLE IF NOT EXISTS id_sequence (
+    id INTEGER PRIMARY KEY AUTOINCREMENT);
+"""
+
+# Table and index columns of each kind
+SQLITE_TABLES = {
+    'User': ('user', ('name',)),
+    'Game': ('game', ('player1', 'player2', 'active', 'last_move')),
+    'GameBoard': ('game_board', ()),
+    'Score': ('score', ('winner', 'ships_remaining')),
+    'Ranking': ('ranking', ('score',)),
+}
+
+# Statements are only ever built from these constant strings with ?
+# parameters, so sqlite3 compiles each once per connection and reuses it
+SQLITE_SELECT = dict(
+    (kind, 'SELECT entity FROM %s WHERE id = ?' % table)
+    for kind, (table, _) in SQLITE_TABLES.iteritems())
+SQLITE_INSERT = dict(
+    (kind, 'INSERT OR REPLACE INTO %s (%s) VALUES (%s)' %
+     (table, ', '.join(('id',) + columns + ('entity',)),
+      ', '.join('?' * (len(columns) + 2))))
+    for kind, (table, columns) in SQLITE_TABLES.iteritems())
+SQLITE_USER_ID = 'SELECT id FROM user WHERE name = ?'
+SQLITE_SCORES = 'SELECT entity FROM score ORDER BY id LIMIT ? OFFSET ?'
+SQLITE_USER_SCORES = \
+    'SELECT entity FROM score WHERE winner = ? ORDER BY id LIMIT ? OFFSET ?'
+SQLITE_HIGH_SCORES = 'SELECT entity FROM score ' \
+    'ORDER BY ships_remaining DESC, id LIMIT ? OFFSET ?'
+SQLITE_ACTIVE_GAMES = 'SELECT entity FROM game_player ' \
+    'JOIN game ON game.id = game_player.game WHERE player = ? ' \
+    'ORDER BY game LIMIT ? OFFSET ?'
+SQLITE_DELETE_GAME_PLAYERS = 'DELETE FROM game_player WHERE game = ?'
+SQLITE_INSERT_GAME_PLAYER = \
+    'INSERT INTO game_player (player, game) VALUES (?, ?)'
+SQLITE_RANKINGS = \
+    'SELECT entity FROM ranking ORDER BY score DESC, id LIMIT ? OFFSET ?'
+SQLITE_CACHED_STATEMENTS = 32
+
+
+class SqliteRepository(_LocalRepository):
+    """Stores the entities in a SQLite database in WAL mode, with one table
+    per kind holding the encoded entities and the columns they are queried
+    on. Each thread has its own connection"""
+
+    def __init__(self, path):
+        if sqlite3 is None:
+            raise ValueError('SQLite is not available')
+        self.path = path
+        self._local = threading.local()
+        self._connection().executescript(SQLITE_SCHEMA)
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            # Transactions are begun and ended explicitly
+            connection = sqlite3.connect(
+                self.path, isolation_level=None,
+                cached_statements=SQLITE_CACHED_STATEMENTS)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+            self._local.depth = 0
+        return connection
+
+    def close(self):
+        # Left to the garbage collector at thread exit, the connection can
+        # deadlock CPython 2.7 finalizing its statements
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            self._local.connection = None
+            connection.close()
+
+    @contextmanager
+    def _transaction(self):
+        connection = self._connection()
+        if self._local.depth:
+            self._local.depth += 1
+            try:
+                yield connection
+            finally:
+                self._local.depth -= 1
+            return
+        connection.execute('BEGIN IMMEDIATE')
+        self._local.depth = 1
+        try:
+            yield connection
+        except Exception:
+            self._local.depth = 0
+            connection.execute('ROLLBACK')
+            raise
+        self._local.depth = 0
+        connection.execute('COMMIT')
+
+    def _allocate_id(self):
+        connection = self._connection()
+        id = connection.execute(
+            'INSERT INTO id_sequence DEFAULT VALUES').lastrowid
+        connection.execute('DELETE FROM id_sequence WHERE id = ?', (id,))
+        return id
+
+    def get_multi_async(self, keys):
+        connection = self._connection()
+        futures = []
+        for key in keys:
+            row = connection.execute(SQLITE_SELECT[key.kind()],
+                                     (_row_id(key),)).fetchone()
+            futures.append(_completed(_decode(row[0]) if row else None))
+        return futures
+
+    def put_multi_async(self, entities):
+        with self._transaction() as connection:
+            for entity in entities:
+                key, values, data = self._prepare(entity)
+                kind = key.kind()
+                columns = SQLITE_TABLES[kind][1]
+                connection.execute(
+                    SQLITE_INSERT[kind],
+                    [_row_id(key)] + [values[column] for column in columns] +
+                    [sqlite3.Binary(data)])
+                if kind == 'Game':
+                    connection.execute(SQLITE_DELETE_GAME_PLAYERS, (key.id(),))
+                    connection.executemany(
+                        SQLITE_INSERT_GAME_PLAYER,
+                        [(player, key.id())
+                         for player in set(values['active_players'])])
+        return [_completed(entity.key) for entity in entities]
+
+    def transaction_async(self, callback):
+        with self._transaction():
+            result = callback().get_result()
+        return _completed(result)
+
+    def in_transaction(self):
+        return getattr(self._local, 'depth', 0) > 0
+
+    def get_user_key(self, name):
+        row = self._connection().execute(SQLITE_USER_ID, (name,)).fetchone()
+        return ndb.Key(User, row[0]) if row else None
+
+    def _page(self, sql, params, page_size, cursor):
+        """Runs a query ending in LIMIT ? OFFSET ?, fetching one more row
+        than the page to know whether there is a next page"""
+        page_size = get_page_size(page_size)
+        offset = _parse_cursor(cursor)
+        rows = self._connection().execute(
+            sql, tuple(params) + (page_size + 1, offset)).fetchall()
+        return [_decode(row[0]) for row in rows[:page_size]], \
+            _next_cursor(offset, page_size, len(rows) > page_size)
+
+    def scores_page(self, page_size, cursor, winner=None, best_first=False):
+        if winner is not None:
+            return self._page(SQLITE_USER_SCORES, (winner.id(),),
+                              page_size, cursor)
+        if best_first:
+            return self._page(SQLITE_HIGH_SCORES, (), page_size, cursor)
+        return self._page(SQLITE_SCORES, (), page_size, cursor)
+
+    def active_games_page(self, user_key, page_size, cursor):
+        return self._page(SQLITE_ACTIVE_GAMES, (user_key.id(),),
+                          page_size, cursor)
+
+    def rankings_page(self, page_size, cursor):
+        return self._page(SQLITE_RANKINGS, (), page_size, cursor)
+
+
+def create_repository(spec):
+    """Returns a new Repository for a BATTLESHIP_STORAGE value"""
+    if spec == 'ndb':
+        return NdbRepository()
+    if spec == 'memory':
+        return MemoryRepository()
+    if spec.startswith('sqlite:'):
+        return SqliteRepository(spec[len('sqlite:'):])
+    raise ValueError('Unknown storage %r' % spec)
+
+
+_repository = None
+_repository_lock = threading.Lock()
+
+
+def get_repository():
+    """Returns the Repository of the app, created on first use from the
+    BATTLESHIP_STORAGE environment variable"""
+    global _repository
+    with _repository_lock:
+        if _repository is None:
+            _repository = create_repository(os.environ.get(STORAGE_ENV,
+                                                           'ndb'))
+        return _repository
+
+
+def set_repository(repository):
+    """Replaces the Repository of the app, for tools running it off App
+    Engine"""
+    global _repository
+    with _repository_lock:
+        _repository = repository
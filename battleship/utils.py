@@ -1,25 +1,40 @@
 """utils.py - File for collecting general utility functions."""
 
 import logging
+import threading
+import uuid
+from collections import OrderedDict
+from google.appengine.api import datastore_errors, memcache
+from google.appengine.datastore import entity_pb
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 import endpoints
 
+from models import User, Game, GameBoard
 
-def get_by_urlsafe(urlsafe, model):
-    """Returns an ndb.Model entity that the urlsafe key points to. Checks
-        that the type of entity returned is of the correct kind. Raises an
-        error if the key String is malformed or the entity is of the incorrect
-        kind
-    Args:
-        urlsafe: A urlsafe key string
-        model: The expected entity kind
-    Returns:
-        The entity that the urlsafe Key string points to or None if no entity
-        exists.
-    Raises:
-        ValueError:"""
+MAX_PAGE_SIZE = 100
+USER_KEY_CACHE_SIZE = 1000
+USER_KEY_MEMCACHE_PREFIX = 'user-key:'
+GAME_VERSION_MEMCACHE_PREFIX = 'game-version:'
+GAME_MEMCACHE_PREFIX = 'game:'
+GAME_BOARDS_MEMCACHE_PREFIX = 'game-boards:'
+GAME_CACHE_SIZE = 500
+# Stored with the token of the writer as the version of a Game while it is
+# written, for at most this many seconds should the writer never record the
+# new version
+GAME_WRITING = 'writing'
+GAME_WRITE_TIMEOUT = 30
+GAME_VERSION_CAS_RETRIES = 3
+# Stored in memcache for names without a User, for this many seconds
+NO_USER = ''
+NO_USER_TIMEOUT = 60
+
+
+def key_from_urlsafe(urlsafe):
+    """Returns the ndb.Key of a urlsafe key string. Raises
+    endpoints.BadRequestException if the string is malformed"""
     try:
-        key = ndb.Key(urlsafe=urlsafe)
+        return ndb.Key(urlsafe=urlsafe)
     except TypeError:
         raise endpoints.BadRequestException('Invalid Key')
     except Exception, e:
@@ -28,9 +43,270 @@ def get_by_urlsafe(urlsafe, model):
         else:
             raise
 
-    entity = key.get()
-    if not entity:
+
+def fetch_page(query, page_size, cursor, **options):
+    """Returns a page of query results and the urlsafe cursor of the next
+    page, or None if this is the last page.
+    Args:
+        query: The ndb.Query to run
+        page_size: Number of results, defaults to and is capped at
+            MAX_PAGE_SIZE
+        cursor: The urlsafe cursor returned with the previous page, if any
+        options: Extra query options such as projection
+    Returns:
+        A tuple of the list of results and the next cursor
+    Raises:
+        endpoints.BadRequestException: If page_size or cursor is invalid"""
+    page_size = get_page_size(page_size)
+    try:
+        start_cursor = Cursor(urlsafe=cursor) if cursor else None
+        results, next_cursor, more = query.fetch_page(
+            page_size, start_cursor=start_cursor, **options)
+    except (datastore_errors.BadValueError,
+            datastore_errors.BadRequestError):
+        raise endpoints.BadRequestException('Invalid cursor')
+    if more and next_cursor:
+        return results, next_cursor.urlsafe()
+    return results, None
+
+
+def get_page_size(page_size):
+    """Returns the requested page size, defaulting to and capped at
+    MAX_PAGE_SIZE. Raises endpoints.BadRequestException if it is not
+    positive"""
+    if page_size is None:
+        return MAX_PAGE_SIZE
+    if page_size < 1:
+        raise endpoints.BadRequestException(
+            'page_size must be a positive number')
+    return min(page_size, MAX_PAGE_SIZE)
+
+
+class LRUCache(object):
+    """Bounded, thread safe in-process cache evicting the least recently used
+    entry"""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                return default
+            self._items[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            if len(self._items) > self.capacity:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+_user_keys = LRUCache(USER_KEY_CACHE_SIZE)
+
+
+def _user_key_memcache_key(name):
+    return USER_KEY_MEMCACHE_PREFIX + name.encode('utf-8')
+
+
+def get_user_key(name):
+    """Returns the key of the User with the given name, or None if there is
+    no such User. Looks in the per-instance LRU, then memcache, and only then
+    queries the datastore. Names never change, so found keys stay valid in
+    the LRU; names without a User are only cached in memcache, briefly and
+    never in place of a key, which cache_user_key records when the User is
+    created."""
+    if not name:
         return None
-    if not isinstance(entity, model):
-        raise ValueError('Incorrect Kind')
-    return entity
+    key = _user_keys.get(name)
+    if key is not None:
+        return key
+
+    memcache_key = _user_key_memcache_key(name)
+    urlsafe = memcache.get(memcache_key)
+    if urlsafe == NO_USER:
+        return None
+    if urlsafe is not None:
+        key = ndb.Key(urlsafe=urlsafe)
+    else:
+        key = User.query(User.name == name).get(keys_only=True)
+        if key is None:
+            # The query is eventually consistent, the User may have just
+            # been created: add, so as not to replace its key
+            memcache.add(memcache_key, NO_USER, time=NO_USER_TIMEOUT)
+            return None
+        memcache.set(memcache_key, key.urlsafe())
+
+    _user_keys.set(name, key)
+    return key
+
+
+def cache_user_key(name, key):
+    """Records the key of a newly created User, replacing any cached
+    'no such User' entry"""
+    memcache.set(_user_key_memcache_key(name), key.urlsafe())
+    _user_keys.set(name, key)
+
+
+_games = LRUCache(GAME_CACHE_SIZE)
+
+
+def clear_local_caches():
+    """Empties the per-instance caches of User keys and Games, for the tools
+    measuring reads on a cold instance"""
+    _user_keys.clear()
+    _games.clear()
+
+
+def _game_version_memcache_key(key):
+    return GAME_VERSION_MEMCACHE_PREFIX + key.urlsafe()
+
+
+def _game_memcache_key(key, version, prefix=GAME_MEMCACHE_PREFIX):
+    return '%s%s:%d' % (prefix, key.urlsafe(), version)
+
+
+def get_game_version(key):
+    """Returns the version of the Game last cached, or None if it is not
+    cached or being written"""
+    version = memcache.get(_game_version_memcache_key(key))
+    return version if isinstance(version, (int, long)) else None
+
+
+@ndb.tasklet
+def _get_cached_async(cache_key, memcache_key):
+    """Looks in the per-instance LRU, then memcache"""
+    data = _games.get(cache_key)
+    if data is None:
+        data = yield ndb.get_context().memcache_get(memcache_key)
+        if data is not None:
+            _games.set(cache_key, data)
+    raise ndb.Return(data)
+
+
+@ndb.tasklet
+def get_cached_game_async(key, boards=False):
+    """Returns a future of the cached Game of the key, or None. With boards,
+    its GameBoards are loaded too, or None is returned if they are not
+    cached. The latest version of each Game is looked up in memcache, and
+    the Game of that version in the per-instance LRU, then memcache. A
+    version of a Game never changes once written, so only the version can
+    be stale, and writers only ever move it forward, see cache_game_async"""
+    version = yield ndb.get_context().memcache_get(
+        _game_version_memcache_key(key))
+    if not isinstance(version, (int, long)):
+        raise ndb.Return(None)
+    data = yield _get_cached_async((key, version),
+                                   _game_memcache_key(key, version))
+    if data is None:
+        raise ndb.Return(None)
+    game = Game._from_pb(entity_pb.EntityProto(data))
+    if boards:
+        game_boards = yield get_cached_game_boards_async(key, version)
+        if game_boards is None:
+            raise ndb.Return(None)
+        game.set_boards(game_boards)
+    raise ndb.Return(game)
+
+
+@ndb.tasklet
+def get_cached_game_boards_async(key, version):
+    """Returns a future of the cached GameBoards of a version of the Game of
+    the key, or None"""
+    packed_boards = yield _get_cached_async(
+        (key, version, GameBoard),
+        _game_memcache_key(key, version, GAME_BOARDS_MEMCACHE_PREFIX))
+    if packed_boards is None:
+        raise ndb.Return(None)
+    raise ndb.Return([GameBoard(key=board_key, board=board)
+                      for board_key, board in
+                      zip(GameBoard.keys_of(key), packed_boards)])
+
+
+@ndb.tasklet
+def cache_game_boards_async(game):
+    """Caches the GameBoards of the version of the Game, if they are
+    loaded"""
+    game_boards = game.game_boards()
+    if game_boards is None:
+        return
+    packed_boards = tuple(game_board.board for game_board in game_boards)
+    _games.set((game.key, game.version, GameBoard), packed_boards)
+    yield ndb.get_context().memcache_set(
+        _game_memcache_key(game.key, game.version,
+                           GAME_BOARDS_MEMCACHE_PREFIX),
+        packed_boards)
+
+
+@ndb.tasklet
+def _store_game_async(game):
+    """Caches the Game, and its GameBoards if they are loaded"""
+    data = game._to_pb().Encode()
+    _games.set((game.key, game.version), data)
+    yield ndb.get_context().memcache_set(
+        _game_memcache_key(game.key, game.version), data), \
+        cache_game_boards_async(game)
+
+
+def lock_game_version_async(game):
+    """Marks the Game as being written until cache_game_async records the
+    new version, so that readers go to the datastore meanwhile. The lock
+    holds a token of this writer, kept on the Game for cache_game_async. To
+    be called before the Game is put. Returns a future"""
+    game._version_lock = (GAME_WRITING, uuid.uuid4().hex)
+    return ndb.get_context().memcache_set(
+        _game_version_memcache_key(game.key), game._version_lock,
+        time=GAME_WRITE_TIMEOUT)
+
+
+@ndb.tasklet
+def cache_game_async(game):
+    """Caches a Game just written and records its version in place of an
+    older version or of the lock of its writer. The version is compared and
+    set, so that writers finishing out of order never leave an older version
+    behind; the lock of another writer is left for that writer to replace,
+    or to expire. Polls are answered from the recorded version. Returns a
+    future"""
+    context = ndb.get_context()
+    memcache_key = _game_version_memcache_key(game.key)
+    yield _store_game_async(game)
+    for _ in range(GAME_VERSION_CAS_RETRIES):
+        version = yield context.memcache_get(memcache_key, for_cas=True)
+        if version is None:
+            stored = yield context.memcache_add(memcache_key, game.version)
+        elif isinstance(version, (int, long)):
+            if version >= game.version:
+                return
+            stored = yield context.memcache_cas(memcache_key, game.version)
+        elif version == game._version_lock:
+            stored = yield context.memcache_cas(memcache_key, game.version)
+        else:
+            return
+        if stored:
+            return
+    logging.warning('Could not record version %d of game %s', game.version,
+                    game.key.urlsafe())
+
+
+@ndb.tasklet
+def add_game_async(game):
+    """Caches a Game just read from the datastore, unless its version is
+    recorded already or the Game is being written. A read racing a write
+    must not record the older version it read. Returns a future"""
+    yield _store_game_async(game)
+    yield ndb.get_context().memcache_add(
+        _game_version_memcache_key(game.key), game.version)
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+
+"""bench.py - Micro-benchmarks of the per move hot paths of the game logic
+and form serialization, compared against stored baselines. Exits with status
+1 when a benchmark is slower than its baseline by more than the threshold.
+
+    APPENGINE_SDK=~/google_appengine python tools/bench.py
+    python tools/bench.py --save     # record new baselines
+
+Everything runs in memory on the testbed stubs of harness.py. Timings are in
+microseconds per operation, the best of --repeat runs. Baselines only compare
+between runs on the same machine, record them again on a new one."""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import random
+import sys
+import timeit
+
+import harness
+
+harness.fix_sys_path()
+
+from google.appengine.ext import ndb  # noqa
+from endpoints.protojson import EndpointsProtoJson  # noqa
+from board import Board, CELL_COUNT, GRID_SIZE, SHIP_CODES, \
+    random_fleet  # noqa
+from game import GameLogic  # noqa
+from models import Game, GridRowNum, MakeMoveForm, NewGameForm  # noqa
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'bench_baseline.json')
+DEFAULT_THRESHOLD = 0.25
+# Minimum duration of one timed run, in seconds
+MIN_RUN_TIME = 0.2
+
+
+def new_game_request():
+    """A NewGameForm placing the fleet of player 1 explicitly"""
+    request = NewGameForm(player1_name='alice')
+    for i, name in enumerate(['aircraft_carrier', 'battleship', 'submarine',
+                              'destroyer', 'patrol_boat']):
+        setattr(request, 'player1_%s_is_horizontal' % name, True)
+        setattr(request, 'player1_%s_start_row' % name, GridRowNum(i * 2))
+        setattr(request, 'player1_%s_start_col' % name, i + 1)
+    return request
+
+
+def mid_game():
+    """A Game halfway through, with every other cell of both boards shot.
+    It is never put, so no datastore call is made"""
+    rand = random.Random(0)
+    boards = [random_fleet(rand), random_fleet(rand)]
+    for board in boards:
+        for cell in range(0, CELL_COUNT, 2):
+            board.shoot(1 << cell)
+    game = Game(key=ndb.Key(Game, 1),
+                player1=ndb.Key('User', 1),
+                player2=ndb.Key('User', 2),
+                current_player=ndb.Key('User', 1),
+                history=[])
+    game._boards = {'1': boards[0], '2': boards[1]}
+    for player, board in zip('12', boards):
+        setattr(game, 'player%s_ships_remaining' % player,
+                board.ships_remaining())
+        for shipcode in SHIP_CODES:
+            setattr(game, 'player%s_%s_remaining' %
+                    (player, GameLogic.ships[shipcode]['name']),
+                    board.remaining(shipcode))
+    names = {game.player1: 'alice', game.player2: 'bob'}
+    return game, names
+
+
+def bench_place_ship_on_grid():
+    request = new_game_request()
+
+    def run():
+        GameLogic.place_ship_on_grid(request, '1')
+    return run, 1
+
+
+def bench_make_move():
+    """Shoots every cell of a fresh board. Building the board is part of
+    the timing, it costs little next to the 100 moves"""
+    game, _ = mid_game()
+    ships = dict(game.get_board('2').ships)
+    moves = [MakeMoveForm(is_player1_move=True,
+                          move_row=GridRowNum(cell // GRID_SIZE),
+                          move_col=cell % GRID_SIZE + 1)
+             for cell in range(CELL_COUNT)]
+
+    def run():
+        game._boards['2'] = Board(ships)
+        for move in moves:
+            GameLogic.make_move(move, game)
+    return run, len(moves)
+
+
+def bench_to_grid_form():
+    game, _ = mid_game()
+    grid = game.primary_grid('1')
+
+    def run():
+        game.to_grid_form(grid)
+    return run, 1
+
+
+def bench_to_game_move_form():
+    game, names = mid_game()
+
+    def run():
+        game.to_game_move_form('Hit!', True, names)
+    return run, 1
+
+
+def bench_to_game_over_form():
+    game, names = mid_game()
+
+    def run():
+        game.to_game_over_form('Game over', names)
+    return run, 1
+
+
+def bench_encode_game_form():
+    """Encodes the largest GameForm the way endpoints writes responses"""
+    game, names = mid_game()
+    form = game.to_game_over_form('Game over', names)
+    protojson = EndpointsProtoJson()
+
+    def run():
+        protojson.encode_message(form)
+    return run, 1
+
+
+def bench_encode_compact_game_form():
+    """The same GameForm in the compact format"""
+    game, names = mid_game()
+    form = game.to_game_over_form('Game over', names, compact=True)
+    protojson = EndpointsProtoJson()
+
+    def run():
+        protojson.encode_message(form)
+    return run, 1
+
+
+BENCHMARKS = [
+    ('place_ship_on_grid', bench_place_ship_on_grid),
+    ('make_move', bench_make_move),
+    ('to_grid_form', bench_to_grid_form),
+    ('to_game_move_form', bench_to_game_move_form),
+    ('to_game_over_form', bench_to_game_over_form),
+    ('encode_game_form', bench_encode_game_form),
+    ('encode_compact_game_form', bench_encode_compact_game_form),
+]
+
+
+def measure(run, ops, repeat):
+    """Returns the best time of repeat runs in microseconds per operation.
+    The number of calls per run grows until a run takes MIN_RUN_TIME"""
+    number = 1
+    while True:
+        elapsed = timeit.timeit(run, number=number)
+        if elapsed >= MIN_RUN_TIME:
+            break
+        number *= 2
+    best = min([elapsed] + timeit.repeat(run, number=number,
+                                         repeat=repeat - 1))
+    return best * 1e6 / (number * ops)
+
+
+def load_baselines(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as baseline_file:
+        return json.load(baseline_file)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('names', nargs='*',
+                        help='benchmarks to run, all of them by default')
+    parser.add_argument('--repeat', type=int, default=7)
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='allowed slowdown, 0.25 fails above +25%%')
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--save', action='store_true',
+                        help='store the results as the new baselines')
+    args = parser.parse_args(argv)
+
+    benchmarks = [(name, setup) for name, setup in BENCHMARKS
+                  if not args.names or name in args.names]
+    if not benchmarks:
+        parser.error('unknown benchmark, choose from %s' %
+                     ', '.join(name for name, _ in BENCHMARKS))
+
+    tb = harness.activate()
+    baselines = load_baselines(args.baseline)
+    results = {}
+    regressions = []
+    print('%-24s %12s %12s %8s' % ('benchmark', 'usec/op', 'baseline',
+                                   'change'))
+    for name, setup in benchmarks:
+        run, ops = setup()
+        results[name] = usec = measure(run, ops, args.repeat)
+        baseline = baselines.get(name)
+        if baseline:
+            change = usec / baseline - 1
+            status = ''
+            if change > args.threshold:
+                regressions.append(name)
+                status = '  REGRESSION'
+            print('%-24s %12.2f %12.2f %+7.1f%%%s' %
+                  (name, usec, baseline, change * 100, status))
+        else:
+            print('%-24s %12.2f %12s %8s' % (name, usec, '-', '-'))
+    tb.deactivate()
+
+    if args.save:
+        baselines.update((name, round(usec, 2))
+                         for name, usec in results.iteritems())
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(baselines, baseline_file, indent=2, sort_keys=True,
+                      separators=(',', ': '))
+            baseline_file.write('\n')
+        print('Baselines saved to %s' % args.baseline)
+    elif regressions:
+        print('%d benchmark(s) slower than baseline by more than %d%%: %s' %
+              (len(regressions), args.threshold * 100,
+               ', '.join(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,62 @@
+"""harness.py - Runs the app outside of dev_appserver for the tools in this
+directory. Puts the App Engine SDK and the battleship directory on sys.path
+and activates the testbed service stubs, so that ndb, memcache, the task
+queue and mail work in memory on a plain Linux box.
+
+The SDK is looked up in the APPENGINE_SDK environment variable, then next to
+a dev_appserver.py found on the PATH."""
+
+import os
+import sys
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       '..', 'battleship')
+
+
+def find_sdk():
+    """Returns the root directory of the App Engine SDK"""
+    sdk = os.environ.get('APPENGINE_SDK')
+    if sdk:
+        return sdk
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        dev_appserver = os.path.join(path, 'dev_appserver.py')
+        if os.path.exists(dev_appserver):
+            return os.path.dirname(os.path.realpath(dev_appserver))
+    sys.exit('App Engine SDK not found, set APPENGINE_SDK to its directory')
+
+
+def fix_sys_path():
+    """Makes the SDK, its bundled libraries and the app importable"""
+    sdk = find_sdk()
+    if sdk not in sys.path:
+        sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    if APP_DIR not in sys.path:
+        sys.path.insert(0, APP_DIR)
+
+
+def activate(require_indexes=False):
+    """Activates the service stubs and returns the Testbed. The datastore is
+    strongly consistent, and with require_indexes queries missing from
+    index.yaml fail as they would in production"""
+    fix_sys_path()
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import ndb
+    from google.appengine.ext import testbed
+
+    tb = testbed.Testbed()
+    tb.activate()
+    # endpoints reads the app version from the environment
+    tb.setup_env(current_version_id='1.1', overwrite=True)
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+    tb.init_datastore_v3_stub(consistency_policy=policy,
+                              require_indexes=require_indexes,
+                              root_path=APP_DIR)
+    tb.init_memcache_stub()
+    tb.init_taskqueue_stub(root_path=APP_DIR)
+    tb.init_mail_stub()
+    tb.init_app_identity_stub()
+    tb.init_urlfetch_stub()
+    ndb.get_context().clear_cache()
+    return tb
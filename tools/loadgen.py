@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+
+"""loadgen.py - Load generator for the API. Plays many games at once
+against the endpoints WSGI app in-process, on the testbed stubs of
+harness.py, and reports the throughput and the p50/p95/p99 latency of each
+endpoint.
+
+    python tools/loadgen.py --games 2000 --concurrency 8 --requests 50000
+    python tools/loadgen.py --duration 60 --record requests.jsonl
+    python tools/loadgen.py --replay requests.jsonl --storage memory
+
+Every game is a client waiting for each response before its next request,
+so --games is the number of games in progress and --concurrency the number
+of requests in flight. Games start with new_game and mostly send make_move
+until they are over, mixed with get_game, get_game_history and the listing
+endpoints in the proportions of MIX. A finished game is replaced by a new
+one.
+
+Request logs are JSON lines with the name of the endpoints method and its
+request body, {"method": "make_move", "body": {...}}. The new_game lines
+also hold the key of the game created in "game". A replay creates the
+Users first, then sends the requests of each game in order, games running
+concurrently, with the recorded game keys mapped to the games created by
+the replay."""
+
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import math
+import random
+import sys
+import threading
+import time
+import Queue
+
+import harness
+
+harness.fix_sys_path()
+
+from google.appengine.ext import ndb  # noqa
+import webapp2  # noqa
+
+SPI_PATH = '/_ah/spi/BattleshipApi.'
+# Sent by the endpoints frontend, the SPI refuses requests without it
+SPI_HEADERS = {'X-AppEngine-Peer': 'apiserving'}
+
+# Relative frequency of the requests of a game in progress
+MIX = [
+    ('make_move', 70),
+    ('get_game', 12),
+    ('get_user_games', 6),
+    ('get_game_history', 3),
+    ('get_scores', 3),
+    ('get_high_scores', 3),
+    ('get_user_rankings', 3),
+]
+# Share of the games played against the Computer
+COMPUTER_GAME_RATIO = 0.2
+ROWS = 'ABCDEFGHIJ'
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(values, p):
+    """Returns the nearest rank percentile of sorted values"""
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+
+class Stats(object):
+    """Latencies and errors of the requests, by endpoints method"""
+
+    def __init__(self):
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.defaultdict(int)
+        self._lock = threading.Lock()
+
+    def add(self, method, latency, status):
+        with self._lock:
+            self.latencies[method].append(latency)
+            if status != 200:
+                self.errors[method] += 1
+
+    def summary(self, elapsed):
+        total = sum(len(values) for values in self.latencies.itervalues())
+        summary = {
+            'requests': total,
+            'errors': sum(self.errors.itervalues()),
+            'elapsed': round(elapsed, 3),
+            'requests_per_sec': round(total / elapsed, 1) if elapsed else None,
+            'endpoints': {},
+        }
+        for method, values in self.latencies.iteritems():
+            values = sorted(values)
+            endpoint = {
+                'requests': len(values),
+                'errors': self.errors[method],
+                'requests_per_sec':
+                    round(len(values) / elapsed, 1) if elapsed else None,
+                'mean_ms': round(sum(values) * 1000 / len(values), 3),
+            }
+            for p in PERCENTILES:
+                endpoint['p%d_ms' % p] = \
+                    round(percentile(values, p) * 1000, 3)
+            summary['endpoints'][method] = endpoint
+        return summary
+
+
+class Client(object):
+    """Sends requests to the endpoints app the way the endpoints frontend
+    does, timing them and optionally writing them to a request log"""
+
+    def __init__(self, app, stats, log=None):
+        self.app = app
+        self.stats = stats
+        self.log = log
+        self._log_lock = threading.Lock()
+
+    def call(self, method, body):
+        """Returns the status and the decoded body of the response"""
+        request = webapp2.Request.blank(
+            SPI_PATH + method, method='POST', body=json.dumps(body),
+            content_type='application/json', headers=SPI_HEADERS)
+        # Each request of the runtime gets a new ndb context
+        ndb.set_context(ndb.make_default_context())
+        start = time.time()
+        response = request.get_response(self.app)
+        self.stats.add(method, time.time() - start, response.status_int)
+        result = json.loads(response.body) if response.body else {}
+        if self.log:
+            line = {'method': method, 'body': body}
+            if method == 'new_game' and 'urlsafe_key' in result:
+                line['game'] = result['urlsafe_key']
+            with self._log_lock:
+                self.log.write(json.dumps(line, sort_keys=True) + '\n')
+        return response.status_int, result
+
+
+class GameClient(object):
+    """One game, started on its first step and restarted when over"""
+
+    def __init__(self, users, rand):
+        self.users = users
+        self.rand = rand
+        self.key = None
+
+    def start(self, client):
+        self.player1 = self.rand.choice(self.users)
+        self.player2 = None
+        body = {'player1_name': self.player1, 'player1_auto_place': True,
+                'player2_auto_place': True}
+        if self.rand.random() >= COMPUTER_GAME_RATIO:
+            self.player2 = self.rand.choice(
+                [user for user in self.users if user != self.player1])
+            body['player2_name'] = self.player2
+        status, result = client.call('new_game', body)
+        if status != 200:
+            return
+        self.key = result['urlsafe_key']
+        self.is_player1_turn = True
+        # The cells each player has not shot yet, in the order to shoot them
+        self.cells = {}
+        for is_player1 in (True, False):
+            cells = range(100)
+            self.rand.shuffle(cells)
+            self.cells[is_player1] = cells
+
+    def step(self, client):
+        if self.key is None:
+            self.start(client)
+            return
+        total = sum(weight for _, weight in MIX)
+        pick = self.rand.uniform(0, total)
+        for method, weight in MIX:
+            pick -= weight
+            if pick <= 0:
+                break
+        if method == 'make_move':
+            self.move(client)
+        elif method in ('get_game', 'get_game_history'):
+            client.call(method, {'urlsafe_game_key': self.key})
+        elif method == 'get_user_games':
+            client.call(method, {'user_name': self.player1})
+        else:
+            client.call(method, {'page_size': 10})
+
+    def move(self, client):
+        cell = self.cells[self.is_player1_turn].pop()
+        status, result = client.call('make_move', {
+            'urlsafe_game_key': self.key,
+            'is_player1_move': self.is_player1_turn,
+            'move_row': ROWS[cell // 10],
+            'move_col': cell % 10 + 1})
+        if status != 200 or result.get('game_over') or \
+                not self.cells[self.is_player1_turn]:
+            self.key = None
+        elif self.player2 is not None:
+            self.is_player1_turn = result['current_player'] == self.player1
+
+
+def run_workers(concurrency, work):
+    """Runs work, a function of the worker index, in concurrency threads.
+    Each closes its connection to the storage backend when done"""
+    import storage
+
+    def run(i):
+        try:
+            work(i)
+        finally:
+            storage.get_repository().close()
+    threads = [threading.Thread(target=run, args=(i,))
+               for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def generate(client, args):
+    """Plays args.games games at once until args.requests requests are sent
+    or args.duration seconds have passed"""
+    users = ['user%d' % i for i in range(args.users)]
+    for user in users:
+        client.call('create_user', {'user_name': user,
+                                    'email': '%s@example.com' % user})
+
+    seeder = random.Random(args.seed)
+    games = Queue.Queue()
+    for _ in range(args.games):
+        games.put(GameClient(users, random.Random(seeder.getrandbits(64))))
+
+    deadline = time.time() + args.duration if args.duration else None
+    sent = [0]
+    lock = threading.Lock()
+
+    def work(_):
+        while True:
+            with lock:
+                if sent[0] >= args.requests:
+                    return
+                sent[0] += 1
+            if deadline and time.time() > deadline:
+                return
+            game = games.get()
+            try:
+                game.step(client)
+            finally:
+                games.put(game)
+    run_workers(args.concurrency, work)
+
+
+def replay(client, args):
+    """Sends the requests of a request log, see the module docstring"""
+    streams = collections.OrderedDict()
+    with open(args.replay) as log:
+        entries = [json.loads(line) for line in log if line.strip()]
+    for entry in entries:
+        if entry['method'] == 'create_user':
+            client.call(entry['method'], entry['body'])
+            continue
+        game = entry.get('game') or entry['body'].get('urlsafe_game_key')
+        # Requests for no game are independent of each other
+        streams.setdefault(game or object(), []).append(entry)
+
+    queue = Queue.Queue()
+    for stream in streams.itervalues():
+        queue.put(stream)
+    keys = {}
+
+    def work(_):
+        while True:
+            try:
+                stream = queue.get_nowait()
+            except Queue.Empty:
+                return
+            for entry in stream:
+                body = dict(entry['body'])
+                if 'urlsafe_game_key' in body:
+                    if body['urlsafe_game_key'] not in keys:
+                        # The game was not created, skip the rest of it
+                        break
+                    body['urlsafe_game_key'] = keys[body['urlsafe_game_key']]
+                status, result = client.call(entry['method'], body)
+                if 'game' in entry and status == 200:
+                    keys[entry['game']] = result['urlsafe_key']
+    run_workers(args.concurrency, work)
+
+
+def print_summary(summary):
+    print('%-20s %9s %7s %9s %9s %9s %9s' % (
+        'endpoint', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms',
+        'p99 ms'))
+    for method, endpoint in sorted(summary['endpoints'].iteritems()):
+        print('%-20s %9d %7d %9.1f %9.2f %9.2f %9.2f' % (
+            method, endpoint['requests'], endpoint['errors'],
+            endpoint['requests_per_sec'], endpoint['p50_ms'],
+            endpoint['p95_ms'], endpoint['p99_ms']))
+    print('%d requests, %d errors in %.1fs, %.1f requests/sec' % (
+        summary['requests'], summary['errors'], summary['elapsed'],
+        summary['requests_per_sec'] or 0))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--games', type=int, default=1000,
+                        help='number of games in progress at once')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='number of requests in flight')
+    parser.add_argument('--requests', type=int, default=20000,
+                        help='number of requests to send')
+    parser.add_argument('--duration', type=float, default=None,
+                        help='seconds after which to stop')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--storage', default='ndb',
+                        help='ndb, memory or sqlite:<path>, see storage.py')
+    parser.add_argument('--record', help='file to write the requests to')
+    parser.add_argument('--replay', help='request log to send instead')
+    parser.add_argument('--output', help='file to write the summary to, '
+                                         'as JSON')
+    args = parser.parse_args(argv)
+    if args.users < 2:
+        parser.error('--users must be at least 2')
+
+    tb = harness.activate()
+    import api
+    import storage
+    storage.set_repository(storage.create_repository(args.storage))
+
+    stats = Stats()
+    log = open(args.record, 'w') if args.record else None
+    client = Client(api.api, stats, log)
+    start = time.time()
+    try:
+        if args.replay:
+            replay(client, args)
+        else:
+            generate(client, args)
+    finally:
+        storage.get_repository().close()
+        if log:
+            log.close()
+    summary = stats.summary(time.time() - start)
+    tb.deactivate()
+
+    print_summary(summary)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(summary, output, indent=2, sort_keys=True,
+                      separators=(',', ': '))
+            output.write('\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+
+"""rpc_budget.py - Checks the datastore calls of each endpoints method
+against its budget. Exits with status 1 when a method makes more gets,
+queries, puts, transactions or other calls than BUDGETS allows, or when a
+listing makes more calls for many items than for one.
+
+    APPENGINE_SDK=~/google_appengine python tools/rpc_budget.py
+
+The methods are called through the endpoints app in-process, on the testbed
+stubs of harness.py, the way loadgen.py calls them. Each is called once to
+warm the caches, then measured on a second call: BUDGETS hold for the
+steady state of a busy app, when the Users and hot Games are in memcache.
+The methods of COLD_BUDGETS are measured again with memcache and the caches
+of the instance emptied. The listings are measured again once every list
+they return is SCALE times longer."""
+
+from __future__ import print_function
+
+import argparse
+import collections
+import sys
+
+import harness
+
+harness.fix_sys_path()
+
+from google.appengine.api import apiproxy_stub_map  # noqa
+from google.appengine.api import memcache  # noqa
+import loadgen  # noqa
+import utils  # noqa
+
+# Most datastore calls allowed per call of each method. rpcs is the sum of
+# gets, queries and puts. Transactions and other calls not listed are not
+# allowed
+BUDGETS = {
+    'create_user': {'gets': 0, 'queries': 1, 'puts': 1},
+    'new_game': {'gets': 0, 'queries': 0, 'puts': 1, 'other': 1},
+    'get_game': {'gets': 0, 'queries': 0, 'puts': 0},
+    'get_game_updates': {'rpcs': 0},
+    'get_game_history': {'gets': 0, 'queries': 0, 'puts': 0},
+    'make_move': {'rpcs': 2, 'transactions': 1},
+    'make_moves': {'rpcs': 2, 'transactions': 1},
+    'cancel_game': {'rpcs': 2, 'transactions': 1},
+    'get_scores': {'gets': 0, 'queries': 1, 'puts': 0},
+    'get_user_scores': {'gets': 0, 'queries': 1, 'puts': 0},
+    'get_high_scores': {'gets': 0, 'queries': 1, 'puts': 0},
+    'get_user_games': {'gets': 0, 'queries': 1, 'puts': 0},
+    'get_user_rankings': {'gets': 0, 'queries': 1, 'puts': 0},
+}
+# The same with nothing cached: the Game and the names of its Users are read
+COLD_BUDGETS = {
+    'get_game': {'gets': 2, 'queries': 0, 'puts': 0},
+    'make_move': {'gets': 2, 'queries': 0, 'puts': 1, 'transactions': 1},
+}
+# Listings whose calls must not grow with the length of the list
+LISTINGS = ['get_user_games', 'get_scores', 'get_user_scores',
+            'get_high_scores', 'get_user_rankings']
+SCALE = 20
+DATASTORE_CALLS = {
+    'Get': 'gets',
+    'RunQuery': 'queries',
+    'Next': 'queries',
+    'Put': 'puts',
+    'BeginTransaction': 'transactions',
+}
+# The commit or rollback ending each transaction, and the index calls the
+# testbed makes on the first query of a kind
+UNCOUNTED_CALLS = ('Commit', 'Rollback', 'CreateIndex', 'UpdateIndex')
+COUNTS = ('gets', 'queries', 'puts', 'transactions', 'other')
+SHIP_NAMES = ['aircraft_carrier', 'battleship', 'submarine', 'destroyer',
+              'patrol_boat']
+ROWS = loadgen.ROWS
+
+
+class Counter(object):
+    """Counts the datastore calls made while measuring"""
+
+    def __init__(self):
+        self.counts = None
+
+    def hook(self, service, call, request, response):
+        if self.counts is not None and call not in UNCOUNTED_CALLS:
+            self.counts[DATASTORE_CALLS.get(call, 'other')] += 1
+
+    def measure(self, client, method, body):
+        self.counts = collections.Counter()
+        try:
+            call(client, method, body)
+        finally:
+            counts, self.counts = self.counts, None
+        counts['rpcs'] = counts['gets'] + counts['queries'] + counts['puts']
+        return counts
+
+
+def call(client, method, body):
+    status, result = client.call(method, body)
+    if status != 200:
+        sys.exit('%s failed with status %d: %s' % (method, status, result))
+    return result
+
+
+def placed_game(player1, player2):
+    """A new_game body with the ships of both players on rows A to E"""
+    body = {'player1_name': player1, 'player2_name': player2}
+    for player in ('1', '2'):
+        for i, name in enumerate(SHIP_NAMES):
+            prefix = 'player%s_%s_' % (player, name)
+            body[prefix + 'is_horizontal'] = True
+            body[prefix + 'start_row'] = ROWS[i]
+            body[prefix + 'start_col'] = 1
+    return body
+
+
+def moves(cells, is_player1_move=True):
+    return [{'is_player1_move': is_player1_move, 'move_row': ROWS[cell // 10],
+             'move_col': cell % 10 + 1} for cell in cells]
+
+
+def play_to_win(client, winner, loser):
+    """Plays a game won by winner, who sinks the ships on rows A to E while
+    loser misses on rows F to J"""
+    key = call(client, 'new_game', placed_game(winner, loser))['urlsafe_key']
+    turns = []
+    for i in range(50):
+        turns += moves([i]) + moves([99 - i], False)
+    call(client, 'make_moves', {'urlsafe_game_key': key, 'moves': turns})
+
+
+def grow(client, prefix, start, stop):
+    """Adds opponents start to stop of prefix-user, each with an active game
+    against prefix-user, a game lost to them and a game won against them"""
+    user = prefix + '-user'
+    for i in range(start, stop):
+        opponent = '%s-opponent%d' % (prefix, i)
+        call(client, 'create_user', {'user_name': opponent})
+        call(client, 'new_game', placed_game(user, opponent))
+        play_to_win(client, user, opponent)
+        play_to_win(client, opponent, user)
+
+
+def check(name, counts, failures, label=None, budgets=BUDGETS):
+    """Prints the counts of method name and records those over budget"""
+    label = label or name
+    budget = dict({'transactions': 0, 'other': 0}, **budgets[name])
+    over = ['%s %d > %d' % (count, counts[count], limit)
+            for count, limit in sorted(budget.iteritems())
+            if counts[count] > limit]
+    if over:
+        failures.append('%s: %s' % (label, ', '.join(over)))
+    print('%-24s %6d %8d %6d %12d %6d %6d  %s' % (
+        label, counts['gets'], counts['queries'], counts['puts'],
+        counts['transactions'], counts['other'], counts['rpcs'],
+        'OVER BUDGET' if over else ''))
+
+
+def measure_methods(client, counter, failures):
+    """Measures the second call of each method in a game in progress"""
+    for user in ('budget-user', 'budget-opponent'):
+        check('create_user', counter.measure(
+            client, 'create_user', {'user_name': user}), failures)
+
+    body = placed_game('budget-user', 'budget-opponent')
+    call(client, 'new_game', body)
+    check('new_game', counter.measure(client, 'new_game', body), failures)
+    game = {'urlsafe_game_key': call(client, 'new_game', body)['urlsafe_key']}
+
+    # Both players miss, on rows F to J
+    player1_cells = iter(range(50, 100))
+    player2_cells = iter(range(99, 49, -1))
+    for name in ('make_move', 'make_moves'):
+        for measured in (False, True):
+            move = moves([next(player1_cells)])
+            if name == 'make_move':
+                body = dict(game, **move[0])
+            else:
+                body = dict(game, moves=move)
+            if measured:
+                check(name, counter.measure(client, name, body), failures)
+            else:
+                call(client, name, body)
+            call(client, 'make_move',
+                 dict(game, **moves([next(player2_cells)], False)[0]))
+
+    for name, body in [('get_game', game),
+                       ('get_game_history', game),
+                       ('get_game_updates', dict(game, version=4))]:
+        call(client, name, body)
+        check(name, counter.measure(client, name, body), failures)
+
+    # Nothing cached, as on a new instance after memcache evicted the game
+    for name, body in [('get_game', game),
+                       ('make_move',
+                        dict(game, **moves([next(player1_cells)])[0]))]:
+        memcache.flush_all()
+        utils.clear_local_caches()
+        check(name, counter.measure(client, name, body), failures,
+              '%s cold' % name, COLD_BUDGETS)
+
+    # A second cancel_game would find the game cancelled already
+    call(client, 'get_game', game)
+    check('cancel_game', counter.measure(client, 'cancel_game', game),
+          failures)
+
+
+def measure_listings(client, counter, failures):
+    """Measures the listings with one item per list, then SCALE"""
+    call(client, 'create_user', {'user_name': 'listing-user'})
+    grow(client, 'listing', 0, 1)
+    bodies = {'get_user_games': {'user_name': 'listing-user'},
+              'get_user_scores': {'user_name': 'listing-user'}}
+    counts = {}
+    for scale in (1, SCALE):
+        if scale > 1:
+            grow(client, 'listing', 1, scale)
+        for name in LISTINGS:
+            body = bodies.get(name, {})
+            call(client, name, body)
+            counts[name, scale] = counter.measure(client, name, body)
+            check(name, counts[name, scale], failures,
+                  '%s x%d' % (name, scale))
+    for name in LISTINGS:
+        small, large = counts[name, 1], counts[name, SCALE]
+        if any(large[count] > small[count] for count in COUNTS):
+            failures.append('%s: %d calls for %d items, %d for 1' % (
+                name, sum(large[count] for count in COUNTS), SCALE,
+                sum(small[count] for count in COUNTS)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.parse_args(argv)
+
+    tb = harness.activate()
+    import api
+    counter = Counter()
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+        'rpc_budget', counter.hook, 'datastore_v3')
+    client = loadgen.Client(api.api, loadgen.Stats())
+
+    failures = []
+    print('%-24s %6s %8s %6s %12s %6s %6s' % (
+        'method', 'gets', 'queries', 'puts', 'transactions', 'other',
+        'rpcs'))
+    measure_methods(client, counter, failures)
+    measure_listings(client, counter, failures)
+    tb.deactivate()
+
+    if failures:
+        print('%d method(s) over budget:' % len(failures))
+        for failure in failures:
+            print('  ' + failure)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+
+"""simulate.py - Headless self-play simulator. Plays complete games between
+two shot strategies through GameLogic.make_move, on Games that are never
+put, spread over a multiprocessing pool. Aggregated results are streamed to
+a file as one JSON object per line, one line per finished chunk of games and
+a final summary line.
+
+    APPENGINE_SDK=~/google_appengine python tools/simulate.py \
+        --games 1000000 --strategies density,random
+
+A strategy is the name of one of STRATEGIES, or module:function for a
+function taking the opponent's Board and returning the cell index to shoot.
+Only what the tracking grid shows may be used: shots, hits and the ship hit
+on each hit cell."""
+
+from __future__ import print_function
+
+import argparse
+import importlib
+import json
+import multiprocessing
+import random
+import time
+
+import harness
+
+harness.fix_sys_path()
+
+from ai import choose_shot  # noqa
+from board import CELL_BITS, CELL_COUNT, GRID_SIZE, random_fleet  # noqa
+from game import GameLogic  # noqa
+from models import Game, GridRowNum, MakeMoveForm  # noqa
+
+
+def random_shot(board):
+    """Shoots any cell not shot yet"""
+    return random.choice([i for i in range(CELL_COUNT)
+                          if not board.shots & CELL_BITS[i]])
+
+
+def parity_shot(board):
+    """Shoots next to a hit on a ship still afloat if there is one,
+    otherwise a random cell of a checkerboard pattern"""
+    open_hits = board.hits
+    for shipcode, mask in board.ships.iteritems():
+        if board.is_sunk(shipcode):
+            open_hits &= ~mask
+    if open_hits:
+        targets = []
+        for i in range(CELL_COUNT):
+            if not open_hits & CELL_BITS[i]:
+                continue
+            row, col = divmod(i, GRID_SIZE)
+            for r, c in ((row - 1, col), (row + 1, col),
+                         (row, col - 1), (row, col + 1)):
+                if 0 <= r < GRID_SIZE and 0 <= c < GRID_SIZE:
+                    cell = r * GRID_SIZE + c
+                    if not board.shots & CELL_BITS[cell]:
+                        targets.append(cell)
+        if targets:
+            return random.choice(targets)
+    cells = [i for i in range(CELL_COUNT)
+             if not board.shots & CELL_BITS[i] and
+             (i // GRID_SIZE + i % GRID_SIZE) % 2 == 0]
+    return random.choice(cells) if cells else random_shot(board)
+
+
+def density_shot(board):
+    """The Computer opponent of the game"""
+    return choose_shot(board)
+
+
+STRATEGIES = {
+    'random': random_shot,
+    'parity': parity_shot,
+    'density': density_shot,
+}
+
+
+def load_strategy(name):
+    # A strategy playing itself is told apart by a #2 suffix
+    name = name.split('#')[0]
+    if name in STRATEGIES:
+        return STRATEGIES[name]
+    module, _, function = name.partition(':')
+    return getattr(importlib.import_module(module), function)
+
+
+def play_game(shooters):
+    """Plays one game between two shot functions, the first one moving
+    first, as player 1. Returns the index of the winner and the shots it
+    fired. Raises ValueError if a shot function shoots a cell twice"""
+    game = Game.new_game(None, None, random_fleet(), random_fleet())
+    shots = [0, 0]
+    player = 0
+    # Every cell of the opponent is shot by then
+    for _ in xrange(2 * CELL_COUNT):
+        opponent = '2' if player == 0 else '1'
+        cell = shooters[player](game.get_board(opponent))
+        if game.get_board(opponent).shots & CELL_BITS[cell]:
+            raise ValueError('Cell %d shot twice' % cell)
+        move = MakeMoveForm(is_player1_move=player == 0,
+                            move_row=GridRowNum(cell // GRID_SIZE),
+                            move_col=cell % GRID_SIZE + 1)
+        _, _, _, is_sunk = GameLogic.make_move(move, game)
+        GameLogic.set_new_ships_remaining(game, is_sunk, player == 0)
+        shots[player] += 1
+        if getattr(game, 'player%s_ships_remaining' % opponent) < 1:
+            return player, shots[player]
+        player = 1 - player
+    raise ValueError('No winner after every cell was shot')
+
+
+def play_chunk(args):
+    """Plays a chunk of games, alternating which strategy moves first, and
+    returns the aggregated results"""
+    names, games, seed = args
+    random.seed(seed)
+    shooters = [load_strategy(name) for name in names]
+    wins = dict((name, 0) for name in names)
+    winning_shots = dict((name, 0) for name in names)
+    for i in xrange(games):
+        order = [i % 2, 1 - i % 2]
+        winner, shots = play_game([shooters[j] for j in order])
+        name = names[order[winner]]
+        wins[name] += 1
+        winning_shots[name] += shots
+    return {'games': games, 'wins': wins, 'winning_shots': winning_shots}
+
+
+def summarize(totals, elapsed):
+    games = totals['games']
+    shots = sum(totals['winning_shots'].itervalues())
+    summary = {
+        'games': games,
+        'elapsed': round(elapsed, 3),
+        'games_per_sec': round(games / elapsed, 1) if elapsed else None,
+        'mean_shots_to_win': round(float(shots) / games, 3) if games else None,
+        'strategies': {},
+    }
+    for name, wins in totals['wins'].iteritems():
+        summary['strategies'][name] = {
+            'win_rate': round(float(wins) / games, 4) if games else None,
+            'mean_shots_to_win':
+                round(float(totals['winning_shots'][name]) / wins, 3)
+                if wins else None,
+        }
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--games', type=int, default=10000,
+                        help='number of games to play')
+    parser.add_argument('--strategies', default='density,random',
+                        help='the two strategies playing each other')
+    parser.add_argument('--processes', type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('--chunk-size', type=int, default=1000,
+                        help='games per task sent to a worker')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--output', default='simulation.jsonl',
+                        help='file the results are streamed to')
+    args = parser.parse_args(argv)
+
+    names = args.strategies.split(',')
+    if len(names) != 2:
+        parser.error('--strategies takes two strategies')
+    for name in names:
+        load_strategy(name)
+    if names[0] == names[1]:
+        names[1] += '#2'
+
+    seeder = random.Random(args.seed)
+    chunks = []
+    remaining = args.games
+    while remaining > 0:
+        games = min(args.chunk_size, remaining)
+        chunks.append((names, games, seeder.getrandbits(64)))
+        remaining -= games
+
+    totals = {'games': 0,
+              'wins': dict((name, 0) for name in names),
+              'winning_shots': dict((name, 0) for name in names)}
+    pool = multiprocessing.Pool(args.processes)
+    start = time.time()
+    with open(args.output, 'w') as output:
+        for result in pool.imap_unordered(play_chunk, chunks):
+            totals['games'] += result['games']
+            for name in names:
+                totals['wins'][name] += result['wins'][name]
+                totals['winning_shots'][name] += \
+                    result['winning_shots'][name]
+            line = summarize(totals, time.time() - start)
+            output.write(json.dumps(line, sort_keys=True) + '\n')
+            output.flush()
+        summary = summarize(totals, time.time() - start)
+        summary['final'] = True
+        output.write(json.dumps(summary, sort_keys=True) + '\n')
+    pool.close()
+    pool.join()
+    print(json.dumps(summary, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()